@@ -29,11 +29,13 @@ import serial
 import time
 
 from serial import SerialException
-from utils import save_meta, save_data
+from adsb_log import AdsbLog
+from adsb_store import AdsbStore
+from track_codec import TrackLog
+from adsb_stats import AdsbStats
+from mav_framer import MavFramer, MAVLINK_MAGIC
 from pymavlink.dialects.v20 import ardupilotmega as mavlink
 
-MAVLINK_MAGIC = 0xfe
-
 # Class to store bytes as they arrive
 class fifo(object):
     def __init__(self):
@@ -51,26 +53,58 @@ class fifo(object):
 class ADSBCom(object):
     ser = ''
     listener_run = True
-    data = b''
+    framer = None
+    mav = None
+    log = None
+    store = None
+    tracks = None
     thread = None
-    adsb_msg_set = set()
-    adsb_icao_set = set()
-    adsb_callsign_set = set()
-    new_icao = False
-    new_callsign = False
 
-    def __init__(self, serial_port='', baudrate=57600, out_fld = '.'):
+    def __init__(self, serial_port='', baudrate=57600, out_fld = '.', flush_records=32, flush_interval=5.0,
+                 track_interval=5, max_aircraft=0, telemetry_interval=10):
         self.serial_port = serial_port
         self.baudrate = baudrate
         self.out_fld = out_fld
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        # aircraft kept in memory, the least recently seen quarter is
+        # spilled to out_fld when exceeded. 0 = no limit
+        self.max_aircraft = max_aircraft
+        # ICAOs spilled so far, one that comes back is not a new aircraft
+        self.spilled = set()
+        # distinct aircraft of the mission, in the store or spilled
+        self.sighted = 0
+        # ADSB_VEHICLE has a fixed v1 payload; a different length means a false magic
+        self.framer = MavFramer(lengths={mavlink.MAVLINK_MSG_ID_ADSB_VEHICLE: 38})
+        # one decoder for the whole mission
+        self.mav = mavlink.MAVLink(fifo())
+        # latest state per ICAO; callsigns already written to cs_file.bin
+        self.store = AdsbStore()
+        self.adsb_callsign_set = set()
+        # quantised samples per ICAO, written as tracks_N.bin on stop
+        self.tracks = TrackLog(track_interval)
+        # frames staged in the store, with a flag if already logged
+        self.staged_frames = []
+        # set when new aircraft are committed or the listener ends, wakes run()
+        self.changed = threading.Event()
+        self.last_new = time.time()
+        # ingest health, framer counters live in self.framer
+        self.decoded = 0
+        self.decode_errors = 0
+        self.listener_errors = 0
+        self.telemetry_interval = telemetry_interval
+        self.stats = None
         print(f'ADSBCom created: serial_port={self.serial_port}, br={self.baudrate}')
 
     def open(self):
         self.listener_run = True
-        if 'PigpioCom' not in str(self.serial_port):
+        # a path opens a serial port; PigpioCom or a replay source is used as is
+        if isinstance(self.serial_port, str):
             self.ser = serial.Serial(self.serial_port, self.baudrate, timeout=0.75)
         else:
             self.ser = self.serial_port
+        self.log = AdsbLog(self.out_fld, self.flush_records, self.flush_interval)
+        self.stats = AdsbStats(self.out_fld, self.telemetry_interval)
         print(f'listener() starting')
         x = threading.Thread(target=self.listener)
         x.start()
@@ -81,28 +115,32 @@ class ADSBCom(object):
             self.listener_run = False
             if hasattr(self.thread, 'join'):
                 self.thread.join()
+            if self.log is not None:
+                self.commit()
+                self.log.close()
+                self.store.export(self.out_fld)
+                self.tracks.save(self.out_fld)
+                self.stats.close(self)
         except Exception as e:
             print(f'Error in stop(): {e}')
 
     def listener(self):
         while self.listener_run:
             try:
-                self.data += self.ser.readline()
-                while self.data.count(MAVLINK_MAGIC) > 2: # There is a frame ready to process
-                    frame_start = self.data.find(MAVLINK_MAGIC) # should be 0
-                    frame_end = self.data[1:].find(MAVLINK_MAGIC) # next frame start
-                    frame = self.data[frame_start : frame_end + 1]
-                    self.data = self.data[frame_end + 1:]
+                for frame in self.framer.push(self.ser.readline()):
                     self.parse_messages(frame)
-                    if self.new_icao or self.new_callsign:
-                        save_meta(len(self.adsb_icao_set), self.out_fld)
-                        save_data(self.adsb_icao_set, self.adsb_callsign_set, self.adsb_msg_set, self.out_fld)
-                        self.new_icao = False
-                        self.new_callsign = False
+                if self.store.due():
+                    self.commit()
+                self.log.tick()
+                if self.stats.due():
+                    self.stats.sample(self)
             except SerialException as e:
                 print(f'Error in listener(): {e}')
+                self.listener_errors += 1
+                self.changed.set()
                 sys.exit(1)
             except Exception as e:
+                self.listener_errors += 1
                 print(f'Error in listener(): {e}')
         print("Serial Com completed")
 
@@ -117,45 +155,110 @@ class ADSBCom(object):
 
     # show incoming mavlink messages
     def parse_messages(self, frame):
-        f = fifo()
-        mav = mavlink.MAVLink(f)
-        # assume, our 0xFE was the start of a packet
-        if len(frame) > 6:
-            # header = self.data[:6]
-            # payload_len = header[1]
+        # frame is cut by MavFramer: starts with 0xFE and matches its length byte
+        # drop other message ids on the header byte, before CRC and unpack
+        if len(frame) > 6 and frame[5] == mavlink.MAVLINK_MSG_ID_ADSB_VEHICLE:
             msg = bytearray(frame)
             try:
-                m2 = mav.decode(msg)
-                # show what fields it has
-                # print("Got a message with id %u and fields %s" % (m2.get_msgId(), m2.get_fieldnames()))
-                # print out the fields
-                # print(m2)
-                if m2.name == 'ADSB_VEHICLE':
-                    print(m2)
-                    # msg_h='fe26e0019cf6a1157400c00c15134065c514942249007d6bb7426501bf01000000524a4133354b20200003011732'
-                    msg_h = msg.hex()
-                    icao = getattr(m2, 'ICAO_address')
-                    if icao not in self.adsb_icao_set:
-                        self.adsb_icao_set.add(icao)
-                        self.adsb_msg_set.add(msg_h)
-                        self.new_icao = True
-
-                    callsign = getattr(m2, 'callsign')
-                    if len(callsign) > 0:
-                        callsign_h = callsign.encode('utf8').hex()
-                        if callsign_h not in self.adsb_callsign_set:
-                            self.adsb_callsign_set.add(callsign_h)
-                            self.adsb_msg_set.add(msg_h)
-                            self.new_callsign = True
-            except:
-                pass
+                m2 = self.mav.decode(msg)
+            except Exception:
+                # bad CRC or payload
+                self.decode_errors += 1
+                return
+            # show what fields it has
+            # print("Got a message with id %u and fields %s" % (m2.get_msgId(), m2.get_fieldnames()))
+            if m2.get_type() == 'ADSB_VEHICLE':
+                self.decoded += 1
+                print(m2)
+                callsign = getattr(m2, 'callsign').encode('utf8')
+                # staged_frames[i] goes with store.stage_buf[i], so the frame
+                # is added together with the stage, before anything can raise
+                k = self.store.stage(m2.ICAO_address, m2.lat, m2.lon, m2.altitude, m2.heading,
+                                     m2.hor_velocity, m2.ver_velocity, m2.squawk, callsign)
+                self.staged_frames.append((msg, False))
+                self.tracks.add(m2.ICAO_address, callsign, m2.lat, m2.lon, m2.altitude)
+                if len(callsign) > 0 and callsign not in self.adsb_callsign_set:
+                    self.adsb_callsign_set.add(callsign)
+                    self.log.add_callsign(callsign)
+                    self.log.add_frame(msg)
+                    self.staged_frames[k] = (msg, True)
+                if self.store.full():
+                    self.commit()
         else:
             return
 
+    # merge staged messages into the store and log first sightings
+    def commit(self):
+        new = self.store.commit()
+        icaos = self.store.stage_buf['icao'][new]
+        first = sum(1 for icao in icaos.tolist() if icao not in self.spilled)
+        self.sighted += first
+        try:
+            for i in new:
+                msg, logged = self.staged_frames[i]
+                self.log.add_icao(int(self.store.stage_buf['icao'][i]))
+                if not logged:
+                    self.log.add_frame(msg)
+        finally:
+            # the store emptied its stage, the next batch starts at 0
+            self.staged_frames = []
+        if self.max_aircraft and len(self.store) > self.max_aircraft:
+            count = len(self.store) - self.max_aircraft * 3 // 4
+            spilled = self.store.spill(count, self.out_fld)
+            self.tracks.spill(spilled, self.out_fld)
+            self.spilled.update(spilled.tolist())
+        if self.max_aircraft and len(self.adsb_callsign_set) > self.max_aircraft:
+            # compact() drops callsigns logged twice
+            self.adsb_callsign_set.clear()
+        if first:
+            self.last_new = time.time()
+            self.changed.set()
+
+    def aircraft(self):
+        # distinct aircraft seen so far, a spilled one that returns counts once
+        return self.sighted
+
+    def is_alive(self):
+        return hasattr(self.thread, 'is_alive') and self.thread.is_alive()
+
+
+def folder_size(path):
+    return sum(e.stat().st_size for e in os.scandir(path) if e.is_file())
+
+
+# Sleep until something happens and return why the mission should end,
+# or None. 0 disables max_icao, max_bytes and idle.
+def wait_stop(adsb, start, timeout, max_icao=0, max_bytes=0, idle=0, poll=1.0):
+    remaining = timeout - (time.time() - start)
+    if remaining <= 0:
+        return 'timeout'
+    adsb.changed.wait(min(remaining, poll))
+    adsb.changed.clear()
+    if not adsb.is_alive():
+        return 'listener'
+    if max_icao and adsb.aircraft() >= max_icao:
+        return 'max_icao'
+    if max_bytes and folder_size(adsb.out_fld) >= max_bytes:
+        return 'max_bytes'
+    if idle and time.time() - adsb.last_new >= idle:
+        return 'idle'
+    return None
+
 
-def run(out_fld = '.', timeout = 60):
+def run(out_fld = '.', timeout = 60, max_icao=None, max_bytes=None, idle=None):
     serial_stream = cfg.get('ENV', 'serial_stream')
     serial_baudrate = int(cfg.get('ENV', 'serial_baudrate'))
+    flush_records = int(cfg.get('LOG', 'flush_records'))
+    flush_interval = float(cfg.get('LOG', 'flush_interval'))
+    track_interval = int(cfg.get('LOG', 'track_interval'))
+    max_aircraft = int(cfg.get('LOG', 'max_aircraft'))
+    telemetry_interval = int(cfg.get('LOG', 'telemetry_interval'))
+    if max_icao is None:
+        max_icao = int(cfg.get('STOP', 'max_icao'))
+    if max_bytes is None:
+        max_bytes = int(cfg.get('STOP', 'max_bytes'))
+    if idle is None:
+        idle = int(cfg.get('STOP', 'idle'))
     if serial_stream == 'serial':
         serial_port = cfg.get('ENV', 'serial_port')
     else:
@@ -164,15 +267,19 @@ def run(out_fld = '.', timeout = 60):
         serial_port = ps.PigpioCom(baudrate=serial_baudrate)
         serial_port.open()
 
-    adsb = ADSBCom(serial_port=serial_port, baudrate=serial_baudrate, out_fld=out_fld)
+    adsb = ADSBCom(serial_port=serial_port, baudrate=serial_baudrate, out_fld=out_fld,
+                   flush_records=flush_records, flush_interval=flush_interval,
+                   track_interval=track_interval, max_aircraft=max_aircraft,
+                   telemetry_interval=telemetry_interval)
     try:
         adsb.open()
         start = time.time()
+        adsb.last_new = start
         print(f'Srart: {time.ctime()}')
-        while time.time() - start < timeout: # timeout in sec
-            # print(int(time.time() - start))
-            pass
-        print(f'Stop: {time.ctime()}')
+        reason = None
+        while reason is None: # timeout in sec
+            reason = wait_stop(adsb, start, timeout, max_icao, max_bytes, idle)
+        print(f'Stop: {time.ctime()}, reason: {reason}, aircraft: {adsb.aircraft()}')
         adsb.stop()
     except KeyboardInterrupt:
         print(time.ctime())
@@ -192,7 +299,9 @@ if __name__ == "__main__":
         out_fld = sys.argv[1]
     if len(sys.argv) > 2:
         timeout = int(sys.argv[2])
-    run(out_fld, timeout)
+    max_icao = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    idle = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    run(out_fld, timeout, max_icao=max_icao, idle=idle)
 
 # Test
 #ICAO_address=3896644, lat=319094624, lon=352276608, altitude_type=0,
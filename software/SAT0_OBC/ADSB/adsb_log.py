@@ -0,0 +1,148 @@
+'''
+    @file adsb_log.py
+    @brief Append-only record log for ADS-B results on SATLLA0 OBC.
+
+    Copyright (C) 2023 @author Rony Ronen
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+import time
+import struct
+
+# The log starts with '.' so MsgGenerator.readMsg never sends it.
+LOG_NAME = '.adsb_log.bin'
+
+# record: kind (1 byte), length (1 byte), payload
+REC_FRAME = 0x4d # 'M' raw MAVLink frame -> datafile.bin
+REC_CALLSIGN = 0x43 # 'C' callsign bytes -> cs_file.bin
+REC_ICAO = 0x49 # 'I' uint32 ICAO address -> ca_file.bin
+
+REC_FILES = {REC_FRAME: 'datafile.bin', REC_CALLSIGN: 'cs_file.bin', REC_ICAO: 'ca_file.bin'}
+
+
+# Collects new records in memory and appends them to the log in batches,
+# every flush_records records or flush_interval seconds, whichever first.
+# compact() turns the log into the files the ground side expects.
+class AdsbLog(object):
+    def __init__(self, out_fld='.', flush_records=32, flush_interval=5.0):
+        self.out_fld = out_fld
+        self.path = os.path.join(out_fld, LOG_NAME)
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.last_flush = time.time()
+        self.f = open(self.path, 'ab')
+
+    def _add(self, kind, data):
+        self.pending.append(bytes((kind, len(data))) + data)
+        if len(self.pending) >= self.flush_records:
+            self.flush()
+
+    def add_frame(self, frame):
+        self._add(REC_FRAME, bytes(frame))
+
+    def add_callsign(self, callsign):
+        self._add(REC_CALLSIGN, callsign)
+
+    def add_icao(self, icao):
+        self._add(REC_ICAO, struct.pack('<I', icao))
+
+    def tick(self):
+        # called from the listener loop, flushes a batch that got old
+        if self.pending and time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+        if not self.pending:
+            return
+        self.f.write(b''.join(self.pending))
+        self.pending = []
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        if self.f is None:
+            return
+        self.flush()
+        self.f.close()
+        self.f = None
+        compact(self.out_fld)
+
+
+def read_records(path):
+    # yields (kind, payload); a record cut by a power loss ends the log
+    with open(path, 'rb') as f:
+        data = f.read()
+    pos = 0
+    while pos + 2 <= len(data):
+        kind, length = data[pos], data[pos + 1]
+        end = pos + 2 + length
+        if end > len(data):
+            break
+        yield kind, data[pos + 2:end]
+        pos = end
+
+
+def compact(out_fld='.'):
+    # write datafile.bin, cs_file.bin, ca_file.bin and _metafile.bin from the log.
+    # An aircraft evicted from memory is logged again when it comes back, so
+    # ICAOs and callsigns are deduplicated here. Each frame follows the record
+    # that caused it and is kept only if that record was kept.
+    path = os.path.join(out_fld, LOG_NAME)
+    if not os.path.isfile(path):
+        return 0
+    # numpy only when there is a log, the controller imports this at boot
+    here = os.path.dirname(os.path.realpath(__file__))
+    if here not in sys.path:
+        sys.path.append(here)
+    from utils import save_meta
+    files = {kind: open(os.path.join(out_fld, name), 'wb') for kind, name in REC_FILES.items()}
+    seen = {REC_ICAO: set(), REC_CALLSIGN: set()}
+    keep_frame = False
+    try:
+        for kind, payload in read_records(path):
+            if kind == REC_FRAME:
+                if keep_frame:
+                    files[kind].write(payload)
+                keep_frame = False
+            elif kind in seen:
+                keep_frame = payload not in seen[kind]
+                if keep_frame:
+                    seen[kind].add(payload)
+                    files[kind].write(payload)
+    finally:
+        for f in files.values():
+            f.close()
+    unique_icao = len(seen[REC_ICAO])
+    save_meta(unique_icao, out_fld)
+    os.remove(path)
+    return unique_icao
+
+
+def recover(outbox='./outbox'):
+    # A mission cut by a crash, a kill or the hard power-off never gets to
+    # close() and its log would stay in the outbox. Compacts the logs left
+    # in the mission folders, called at boot before the outbox is indexed.
+    # Returns the folders done.
+    done = []
+    for entry in os.scandir(outbox):
+        if entry.is_dir() and os.path.isfile(os.path.join(entry.path, LOG_NAME)):
+            print(f'Compact ADS-B log left in {entry.path}')
+            compact(entry.path)
+            done.append(entry.name)
+    return done
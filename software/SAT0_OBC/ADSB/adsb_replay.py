@@ -0,0 +1,184 @@
+'''
+    @file adsb_replay.py
+    @brief Offline ADS-B replay benchmark for SATLLA0 OBC.
+
+    Feeds recorded or synthetic MAVLink streams into ADSBCom without a radio.
+    Copyright (C) 2023 @author Rony Ronen
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+
+import time
+import random
+import argparse
+import tempfile
+import threading
+import contextlib
+import tracemalloc
+import resource
+
+from utils import readtxt
+from adsb_listener import ADSBCom
+from adsb_store import load, STORE_NAME
+from pymavlink.dialects.v20 import ardupilotmega as mavlink
+
+
+# Stand-in for serial.Serial/PigpioCom: readline() hands out the stream in
+# chunks, paced to rate bytes per second (0 = as fast as possible).
+class ReplaySerial(object):
+    def __init__(self, stream, rate=0, chunk=256):
+        self.stream = stream
+        self.rate = rate
+        self.chunk = chunk
+        self.pos = 0
+        self.start = None
+        self.done = threading.Event()
+
+    def readline(self):
+        if self.start is None:
+            self.start = time.monotonic()
+        if self.pos >= len(self.stream):
+            self.done.set()
+            time.sleep(0.01)
+            return b''
+        end = min(self.pos + self.chunk, len(self.stream))
+        if self.rate:
+            # wait until the line would have delivered these bytes
+            due = self.start + end / self.rate
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        data = self.stream[self.pos:end]
+        self.pos = end
+        return data
+
+
+def synth_stream(frames=10000, aircraft=200, other=0.5, seed=0):
+    # ADSB_VEHICLE frames from straight-line aircraft, mixed with other
+    # message types so that `other` of all frames are not ADS-B.
+    # Returns (stream, number of ADSB_VEHICLE frames).
+    rnd = random.Random(seed)
+    mav = mavlink.MAVLink(None, srcSystem=1, srcComponent=156)
+    planes = [(rnd.randrange(1 << 24), f'SAT{i:04d}'.encode(), rnd.randrange(-600000000, 600000000),
+               rnd.randrange(-1800000000, 1800000000), rnd.randrange(300000, 12000000)) for i in range(aircraft)]
+    fillers = [mavlink.MAVLink_heartbeat_message(1, 2, 3, 4, 5, 3),
+               mavlink.MAVLink_attitude_message(1, .1, .2, .3, .4, .5, .6),
+               mavlink.MAVLink_sys_status_message(0, 0, 0, 500, 12000, -1, 90, 0, 0, 0, 0, 0, 0)]
+    out = []
+    n_adsb = 0
+    for i in range(frames):
+        if rnd.random() < other:
+            msg = rnd.choice(fillers)
+        else:
+            icao, callsign, lat, lon, alt = rnd.choice(planes)
+            msg = mavlink.MAVLink_adsb_vehicle_message(icao, lat + i * 50, lon + i * 50, 0, alt, 9000, 22000, 0,
+                                                       callsign, 3, 1, 447, 0)
+            n_adsb += 1
+        out.append(bytes(msg.pack(mav, force_mavlink1=True)))
+    return b''.join(out), n_adsb
+
+
+def load_stream(path):
+    # .txt: one hex frame per line (datafile.txt), anything else: raw bytes
+    if path.endswith('.txt'):
+        frames = [bytearray.fromhex(line) for line in readtxt(path)]
+        return b''.join(frames), sum(1 for f in frames if len(f) > 5 and f[5] == mavlink.MAVLINK_MSG_ID_ADSB_VEHICLE)
+    with open(path, 'rb') as f:
+        data = f.read()
+    return data, data.count(bytes([0xfe, 38])) # rough: ADSB_VEHICLE headers
+
+
+def corrupt(stream, level=0.0, seed=0):
+    # flip one random bit in each byte with probability level
+    if level <= 0:
+        return stream
+    rnd = random.Random(seed)
+    data = bytearray(stream)
+    for _ in range(int(len(data) * level)):
+        data[rnd.randrange(len(data))] ^= 1 << rnd.randrange(8)
+    return bytes(data)
+
+
+def replay(stream, expected, rate=0, chunk=256, out_fld=None, quiet=True, trace_memory=False, max_aircraft=0):
+    # run one ADSBCom over the stream and return the measured figures.
+    # tracemalloc slows every allocation, so CPU figures from a traced run
+    # are not comparable with untraced ones.
+    out_fld = out_fld or tempfile.mkdtemp(prefix='adsb_replay_')
+    os.makedirs(out_fld, exist_ok=True)
+    src = ReplaySerial(stream, rate, chunk)
+    if trace_memory:
+        tracemalloc.start()
+    sink = open(os.devnull, 'w') if quiet else sys.stdout
+    with contextlib.redirect_stdout(sink):
+        adsb = ADSBCom(serial_port=src, out_fld=out_fld, max_aircraft=max_aircraft)
+        wall = time.monotonic()
+        cpu = time.process_time()
+        adsb.open()
+        src.done.wait()
+        adsb.stop()
+        cpu = time.process_time() - cpu
+        wall = time.monotonic() - wall
+    decoded = int(load(os.path.join(out_fld, STORE_NAME))['hits'].sum())
+    result = {
+        'bytes': len(stream),
+        'adsb_frames': expected,
+        'decoded': decoded,
+        'dropped': max(expected - decoded, 0),
+        'aircraft': adsb.aircraft(),
+        'decode_errors': adsb.decode_errors,
+        'resyncs': adsb.framer.resyncs,
+        'peak_pending': adsb.framer.peak_pending,
+        'wall_s': wall,
+        'frames_per_s': decoded / wall if wall else 0,
+        'cpu_us_per_frame': cpu * 1e6 / max(decoded, 1),
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'out_fld': out_fld,
+    }
+    if trace_memory:
+        result['peak_py_kb'] = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+    return result
+
+
+def report(result):
+    for key, value in result.items():
+        print(f'{key:>16}: {value:.2f}' if isinstance(value, float) else f'{key:>16}: {value}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay MAVLink streams through ADSBCom')
+    parser.add_argument('stream', nargs='?', help='recorded stream (.txt hex lines or raw .bin); synthetic if omitted')
+    parser.add_argument('--frames', type=int, default=10000, help='synthetic frames')
+    parser.add_argument('--aircraft', type=int, default=200, help='synthetic aircraft')
+    parser.add_argument('--other', type=float, default=0.5, help='share of non ADS-B frames')
+    parser.add_argument('--corrupt', type=float, default=0.0, help='bit flips per byte')
+    parser.add_argument('--baudrate', type=int, default=0, help='pace the stream, 0 = as fast as possible')
+    parser.add_argument('--chunk', type=int, default=256, help='bytes per readline()')
+    parser.add_argument('--out', default=None, help='output folder, temporary if omitted')
+    parser.add_argument('--max-aircraft', type=int, default=0, help='aircraft kept in memory, 0 = no limit')
+    parser.add_argument('--trace-memory', action='store_true', help='measure peak Python heap (slow)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.stream:
+        stream, expected = load_stream(args.stream)
+    else:
+        stream, expected = synth_stream(args.frames, args.aircraft, args.other, args.seed)
+    stream = corrupt(stream, args.corrupt, args.seed)
+    report(replay(stream, expected, args.baudrate // 10, args.chunk, args.out, trace_memory=args.trace_memory,
+                  max_aircraft=args.max_aircraft))
@@ -0,0 +1,131 @@
+'''
+    @file adsb_stats.py
+    @brief Ingest-health telemetry for the SATLLA0 ADS-B listener.
+
+    Copyright (C) 2023 @author Rony Ronen
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import time
+import struct
+
+TELEMETRY_NAME = '_adsb_telemetry.bin'
+TELEMETRY_VERSION = 2 # 1 had a u8 histogram count, still read
+
+# File: version (1 byte), then records starting with a kind byte.
+# 'S' sample, cumulative since the listener started:
+#   t secs (u16), bytes in (u32), frames (u32), ADSB_VEHICLE decoded (u32),
+#   aircraft (u16), decode errors (u16), resyncs (u16), listener errors (u16),
+#   peak framer buffer depth (u16)
+# 'H' frames per message id, written once on stop:
+#   count (u16, all 256 ids can show up on a noisy link),
+#   then count x (msg id u8, frames u32)
+REC_SAMPLE = 0x53
+REC_HISTOGRAM = 0x48
+SAMPLE = struct.Struct('<BHIIIHHHHH')
+HIST_HEADER = struct.Struct('<BH')
+HIST_ITEM = struct.Struct('<BI')
+
+MAX_U16 = 0xffff
+MAX_U32 = 0xffffffff
+
+
+# Copies the listener counters into the telemetry file every interval secs.
+class AdsbStats(object):
+    def __init__(self, out_fld='.', interval=10):
+        self.path = os.path.join(out_fld, TELEMETRY_NAME)
+        self.interval = interval
+        self.start = time.time()
+        self.last = self.start
+        with open(self.path, 'wb') as fbin:
+            fbin.write(bytes([TELEMETRY_VERSION]))
+
+    def due(self):
+        return self.interval and time.time() - self.last >= self.interval
+
+    def sample(self, adsb):
+        self.last = time.time()
+        framer = adsb.framer
+        u16 = lambda x: min(x, MAX_U16)
+        u32 = lambda x: min(x, MAX_U32)
+        rec = SAMPLE.pack(REC_SAMPLE, u16(int(self.last - self.start)), u32(framer.bytes_in), u32(framer.frames),
+                          u32(adsb.decoded), u16(adsb.aircraft()), u16(adsb.decode_errors), u16(framer.resyncs),
+                          u16(adsb.listener_errors), u16(framer.peak_pending))
+        with open(self.path, 'ab') as fbin:
+            fbin.write(rec)
+
+    def close(self, adsb):
+        # last sample and the message id histogram
+        self.sample(adsb)
+        ids = [(i, n) for i, n in enumerate(adsb.framer.msg_ids) if n]
+        with open(self.path, 'ab') as fbin:
+            fbin.write(HIST_HEADER.pack(REC_HISTOGRAM, len(ids)))
+            for i, n in ids:
+                fbin.write(HIST_ITEM.pack(i, min(n, MAX_U32)))
+
+
+def load(path):
+    # ground side: returns (samples as dicts, {msg id: frames})
+    names = ('t', 'bytes_in', 'frames', 'decoded', 'aircraft', 'decode_errors', 'resyncs',
+             'listener_errors', 'peak_pending')
+    with open(path, 'rb') as fbin:
+        data = fbin.read()
+    samples = []
+    hist = {}
+    version = data[0] if data else TELEMETRY_VERSION
+    pos = 1
+    while pos < len(data):
+        kind = data[pos]
+        if kind == REC_SAMPLE and pos + SAMPLE.size <= len(data):
+            samples.append(dict(zip(names, SAMPLE.unpack_from(data, pos)[1:])))
+            pos += SAMPLE.size
+        elif kind == REC_HISTOGRAM and version == 1 and pos + 2 <= len(data):
+            count = data[pos + 1]
+            pos += 2
+            for _ in range(count):
+                i, n = HIST_ITEM.unpack_from(data, pos)
+                hist[i] = n
+                pos += HIST_ITEM.size
+        elif kind == REC_HISTOGRAM and pos + HIST_HEADER.size <= len(data):
+            count = HIST_HEADER.unpack_from(data, pos)[1]
+            pos += HIST_HEADER.size
+            for _ in range(count):
+                i, n = HIST_ITEM.unpack_from(data, pos)
+                hist[i] = n
+                pos += HIST_ITEM.size
+        else:
+            break
+    return samples, hist
+
+
+if __name__ == "__main__":
+    # every message id seen, as after resyncs on a noisy link
+    import shutil
+    import tempfile
+    from types import SimpleNamespace
+
+    work = tempfile.mkdtemp(prefix='adsb_stats_')
+    framer = SimpleNamespace(bytes_in=1 << 20, frames=5000, resyncs=40, peak_pending=300,
+                             msg_ids=[i + 1 for i in range(256)])
+    adsb = SimpleNamespace(framer=framer, decoded=4000, decode_errors=3, listener_errors=0,
+                           aircraft=lambda: 120)
+    stats = AdsbStats(work, 10)
+    stats.close(adsb)
+    samples, hist = load(stats.path)
+    assert len(samples) == 1 and samples[0]['aircraft'] == 120
+    assert hist == {i: i + 1 for i in range(256)}, len(hist)
+    print(f'histogram: {len(hist)} ids, ok')
+    shutil.rmtree(work)
@@ -0,0 +1,195 @@
+'''
+    @file adsb_store.py
+    @brief Columnar per-aircraft store for decoded ADSB_VEHICLE records.
+
+    Copyright (C) 2023 @author Rony Ronen
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import time
+import numpy as np
+
+STORE_NAME = 'adsb_store.bin'
+SPILL_NAME = '.adsb_spill.bin' # rows evicted from memory, same layout
+
+# One packed little-endian row per aircraft (36 bytes), units as in ADSB_VEHICLE:
+# lat/lon degE7, altitude mm, heading cdeg, velocities cm/s,
+# hits = messages received, last_seen = seconds since the store was created.
+ADSB_DTYPE = np.dtype([
+    ('icao', '<u4'),
+    ('lat', '<i4'),
+    ('lon', '<i4'),
+    ('altitude', '<i4'),
+    ('heading', '<u2'),
+    ('hor_velocity', '<u2'),
+    ('ver_velocity', '<i2'),
+    ('squawk', '<u2'),
+    ('callsign', 'S8'),
+    ('hits', '<u2'),
+    ('last_seen', '<u2'),
+])
+
+# fields overwritten by the newest message of an aircraft
+STATE_FIELDS = ('lat', 'lon', 'altitude', 'heading', 'hor_velocity', 'ver_velocity', 'squawk', 'last_seen')
+
+MAX_U16 = 0xffff
+
+
+# Messages are staged into a fixed batch array and merged into the store
+# with a handful of NumPy calls per batch. Rows are kept in arrival order;
+# keys/rows hold the ICAO addresses sorted for searchsorted lookups.
+class AdsbStore(object):
+    def __init__(self, capacity=256, batch=64, commit_interval=1.0):
+        self.data = np.zeros(capacity, dtype=ADSB_DTYPE)
+        self.n = 0
+        self.keys = np.zeros(0, dtype='<u4')
+        self.rows = np.zeros(0, dtype=np.intp)
+        self.batch = batch
+        self.stage_buf = np.zeros(batch, dtype=ADSB_DTYPE)
+        self.staged = 0
+        self.commit_interval = commit_interval
+        self.last_commit = time.time()
+        self.start = time.time()
+
+    def __len__(self):
+        return self.n
+
+    def records(self):
+        return self.data[:self.n]
+
+    def stage(self, icao, lat, lon, altitude, heading, hor_velocity, ver_velocity, squawk, callsign):
+        # returns the staging index; the caller commits once full() is True
+        k = self.staged
+        seen = min(int(time.time() - self.start), MAX_U16)
+        self.stage_buf[k] = (icao, lat, lon, altitude, heading, hor_velocity, ver_velocity,
+                             squawk, callsign, 1, seen)
+        self.staged = k + 1
+        return k
+
+    def full(self):
+        return self.staged >= self.batch
+
+    def due(self):
+        return self.staged > 0 and (self.full() or time.time() - self.last_commit >= self.commit_interval)
+
+    def _grow(self, need):
+        cap = len(self.data)
+        if need <= cap:
+            return
+        while cap < need:
+            cap *= 2
+        data = np.zeros(cap, dtype=ADSB_DTYPE)
+        data[:self.n] = self.data[:self.n]
+        self.data = data
+
+    def commit(self):
+        # merge the staged batch, returns staging indices of first sightings
+        self.last_commit = time.time()
+        k = self.staged
+        if k == 0:
+            return np.zeros(0, dtype=np.intp)
+        self.staged = 0
+        batch = self.stage_buf[:k]
+        icao = batch['icao']
+        uniq, first, counts = np.unique(icao, return_index=True, return_counts=True)
+        _, last_rev = np.unique(icao[::-1], return_index=True)
+        last = k - 1 - last_rev
+        latest = batch[last]
+        # the last non-empty callsign in the batch, the newest message may have none
+        named = np.flatnonzero(batch['callsign'] != b'')
+        if len(named):
+            named_icao, named_rev = np.unique(icao[named][::-1], return_index=True)
+            latest['callsign'][np.searchsorted(uniq, named_icao)] = batch['callsign'][named[::-1][named_rev]]
+
+        pos = np.searchsorted(self.keys, uniq)
+        found = np.zeros(len(uniq), dtype=bool)
+        inside = pos < len(self.keys)
+        found[inside] = self.keys[pos[inside]] == uniq[inside]
+
+        # known aircraft: newest state, add hits, keep the last non-empty callsign
+        if found.any():
+            rows = self.rows[pos[found]]
+            upd = latest[found]
+            for name in STATE_FIELDS:
+                self.data[name][rows] = upd[name]
+            hits = self.data['hits'][rows].astype(np.uint32) + counts[found]
+            self.data['hits'][rows] = np.minimum(hits, MAX_U16)
+            named = upd['callsign'] != b''
+            self.data['callsign'][rows[named]] = upd['callsign'][named]
+
+        # new aircraft: append rows and insert their keys in order
+        new = ~found
+        m = int(new.sum())
+        if m:
+            self._grow(self.n + m)
+            new_rows = np.arange(self.n, self.n + m)
+            self.data[new_rows] = latest[new]
+            self.data['hits'][new_rows] = np.minimum(counts[new], MAX_U16)
+            self.keys = np.insert(self.keys, pos[new], uniq[new])
+            self.rows = np.insert(self.rows, pos[new], new_rows)
+            self.n += m
+        return np.sort(first[new])
+
+    def spill(self, count, out_fld='.'):
+        # move the count least recently seen rows to the spill file,
+        # returns their ICAO addresses
+        n = self.n
+        count = min(count, n)
+        if count <= 0:
+            return np.zeros(0, dtype='<u4')
+        old = np.argpartition(self.data['last_seen'][:n], count - 1)[:count]
+        keep = np.ones(n, dtype=bool)
+        keep[old] = False
+        with open(os.path.join(out_fld, SPILL_NAME), 'ab') as fbin:
+            fbin.write(self.data[old].tobytes())
+        icaos = self.data['icao'][old].copy()
+        self.data[:n - count] = self.data[:n][keep]
+        self.n = n - count
+        self.rows = np.argsort(self.data['icao'][:self.n])
+        self.keys = self.data['icao'][:self.n][self.rows]
+        return icaos
+
+    def export(self, out_fld='.'):
+        # fixed-width dump of all aircraft, see ADSB_DTYPE for the layout
+        records = self.records()
+        spill = os.path.join(out_fld, SPILL_NAME)
+        if os.path.isfile(spill):
+            records = merge(np.concatenate([load(spill), records]))
+            os.remove(spill)
+        path = os.path.join(out_fld, STORE_NAME)
+        with open(path, 'wb') as fbin:
+            fbin.write(records.tobytes())
+        return path
+
+
+def merge(records):
+    # one row per ICAO: newest state, summed hits, newest non-empty callsign
+    order = np.lexsort((records['last_seen'], records['icao']))
+    records = records[order]
+    icao, start = np.unique(records['icao'], return_index=True)
+    end = np.append(start[1:], len(records)) - 1
+    out = records[end].copy()
+    hits = np.add.reduceat(records['hits'].astype(np.uint32), start)
+    out['hits'] = np.minimum(hits, MAX_U16)
+    named = records['callsign'] != b''
+    by_name = np.lexsort((records['last_seen'], named, records['icao']))
+    out['callsign'] = records['callsign'][by_name][end]
+    return out
+
+
+def load(path):
+    # ground side: read an exported store back into a structured array
+    return np.fromfile(path, dtype=ADSB_DTYPE)
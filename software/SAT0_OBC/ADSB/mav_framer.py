@@ -0,0 +1,101 @@
+'''
+    @file mav_framer.py
+    @brief Incremental MAVLink v1 framer for SATLLA0 OBC.
+
+    Copyright (C) 2023 @author Rony Ronen
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+MAVLINK_MAGIC = 0xfe
+MAVLINK_HEADER_LEN = 6 # magic, len, seq, sysid, compid, msgid
+MAVLINK_CRC_LEN = 2
+MAVLINK_MAX_FRAME = MAVLINK_HEADER_LEN + 255 + MAVLINK_CRC_LEN
+
+
+# Cut MAVLink v1 frames out of a byte stream using the header length byte.
+# Bytes live in one preallocated bytearray between _head and _tail; only the
+# unfinished tail (at most one frame) is moved when the buffer wraps, so the
+# work per frame does not depend on how much data is queued.
+class MavFramer(object):
+    def __init__(self, size=4096, lengths=None):
+        # lengths: optional {msg_id: payload_len} used to reject bad headers
+        self.size = max(size, 2 * MAVLINK_MAX_FRAME)
+        self.buf = bytearray(self.size)
+        self.lengths = lengths or {}
+        self._head = 0
+        self._tail = 0
+        # ingest counters, read by AdsbStats
+        self.bytes_in = 0
+        self.frames = 0
+        self.resyncs = 0
+        self.peak_pending = 0
+        self.msg_ids = [0] * 256
+
+    def pending(self):
+        return self._tail - self._head
+
+    def reset(self):
+        self._head = 0
+        self._tail = 0
+
+    def push(self, data):
+        # yields every complete frame (bytearray) found after adding data
+        view = memoryview(data)
+        self.bytes_in += len(view)
+        while len(view):
+            if self._tail == self.size:
+                self._compact()
+            n = min(len(view), self.size - self._tail)
+            self.buf[self._tail:self._tail + n] = view[:n]
+            self._tail += n
+            view = view[n:]
+            yield from self._frames()
+        if self._tail - self._head > self.peak_pending:
+            self.peak_pending = self._tail - self._head
+
+    def _compact(self):
+        n = self._tail - self._head
+        if n and self._head:
+            self.buf[:n] = self.buf[self._head:self._tail]
+        self._head = 0
+        self._tail = n
+
+    def _resync(self, start):
+        # drop bytes up to the next magic byte after start
+        self.resyncs += 1
+        idx = self.buf.find(MAVLINK_MAGIC, start, self._tail)
+        self._head = idx if idx >= 0 else self._tail
+
+    def _frames(self):
+        buf = self.buf
+        while self._tail - self._head >= MAVLINK_HEADER_LEN:
+            head = self._head
+            if buf[head] != MAVLINK_MAGIC:
+                self._resync(head)
+                continue
+            payload_len = buf[head + 1]
+            expected = self.lengths.get(buf[head + 5])
+            if expected is not None and expected != payload_len:
+                self._resync(head + 1)
+                continue
+            frame_len = MAVLINK_HEADER_LEN + payload_len + MAVLINK_CRC_LEN
+            if self._tail - head < frame_len:
+                break
+            self._head = head + frame_len
+            self.frames += 1
+            self.msg_ids[buf[head + 5]] += 1
+            yield buf[head:head + frame_len]
+        if self._head == self._tail:
+            self.reset()
@@ -0,0 +1,299 @@
+'''
+    @file track_codec.py
+    @brief Delta-quantised ADS-B track encoding for SATLLA0 OBC downlink.
+
+    Copyright (C) 2023 @author Rony Ronen
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import time
+
+# File layout (one outbox file, at most MAX_FILE_BYTES):
+#   version (1 byte), block count (2 bytes LE), then byte-aligned blocks.
+# Block (one aircraft, up to MAX_BLOCK_SAMPLES samples), MSB-first bits:
+#   icao 24 (ICAO_ESCAPE then icao 32 for addresses of 24 bits or more and
+#   for ICAO_ESCAPE itself, MAVLink carries a uint32), callsign 8 x 6-bit
+#   chars, samples-1 8,
+#   first sample: t 16, lat 22, lon 22, alt 14 (two's complement),
+#   next samples: dt, dlat, dlon, dalt as zigzag exp-Golomb codes.
+# Units after quantisation: t seconds, lat/lon 1e-4 deg (~11 m), alt 25 ft.
+TRACK_VERSION = 2 # 1 had no ICAO_ESCAPE, decoded as well
+TRACK_NAME = 'tracks'
+SPILL_NAME = '.tracks_spill.bin' # blocks of evicted aircraft, u16 LE length prefixed
+MAX_FILE_BYTES = 16383 # Controller.msgArrived drops payloads of 16384 bytes or more
+MAX_BLOCK_SAMPLES = 256
+
+Q_LATLON = 1000 # degE7 per step
+Q_ALT = 7620 # mm per step (25 ft, the ADS-B altitude increment)
+
+BITS_ICAO = 24
+BITS_ICAO_FULL = 32
+ICAO_ESCAPE = (1 << BITS_ICAO) - 1
+BITS_CHAR = 6
+CALLSIGN_LEN = 8
+BITS_COUNT = 8
+BITS_T = 16
+BITS_LAT = 22
+BITS_LON = 22
+BITS_ALT = 14
+
+# exp-Golomb orders for dt, dlat, dlon, dalt
+K_DT = 2
+K_LATLON = 3
+K_ALT = 1
+
+CHARSET = ' ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789abcdefghijklmnopqrstuvwxyz?'
+CHAR_CODE = {c: i for i, c in enumerate(CHARSET)}
+
+
+class BitWriter(object):
+    def __init__(self):
+        self.acc = 0
+        self.nbits = 0
+
+    def write(self, value, bits):
+        self.acc = (self.acc << bits) | (value & ((1 << bits) - 1))
+        self.nbits += bits
+
+    def write_signed(self, value, bits):
+        self.write(value & ((1 << bits) - 1), bits)
+
+    def write_eg(self, value, k):
+        # exp-Golomb of order k for value >= 0
+        value += 1 << k
+        n = value.bit_length()
+        self.write(0, n - k - 1)
+        self.write(value, n)
+
+    def write_delta(self, value, k):
+        self.write_eg((value << 1) ^ (value >> 63), k)
+
+    def tobytes(self):
+        pad = -self.nbits % 8
+        return (self.acc << pad).to_bytes((self.nbits + pad) // 8, 'big')
+
+
+class BitReader(object):
+    def __init__(self, data):
+        self.acc = int.from_bytes(data, 'big')
+        self.total = len(data) * 8
+        self.pos = 0
+
+    def read(self, bits):
+        self.pos += bits
+        if self.pos > self.total:
+            raise ValueError('track block truncated')
+        return (self.acc >> (self.total - self.pos)) & ((1 << bits) - 1)
+
+    def read_signed(self, bits):
+        value = self.read(bits)
+        return value - (1 << bits) if value >> (bits - 1) else value
+
+    def read_eg(self, k):
+        zeros = 0
+        while self.read(1) == 0:
+            zeros += 1
+        value = (1 << (zeros + k)) | self.read(zeros + k)
+        return value - (1 << k)
+
+    def read_delta(self, k):
+        value = self.read_eg(k)
+        return (value >> 1) ^ -(value & 1)
+
+    def align(self):
+        self.pos += -self.pos % 8
+
+
+def _clamp(value, bits):
+    return max(-(1 << (bits - 1)), min(value, (1 << (bits - 1)) - 1))
+
+
+def quantise(lat, lon, altitude):
+    return (_clamp(round(lat / Q_LATLON), BITS_LAT), _clamp(round(lon / Q_LATLON), BITS_LON),
+            _clamp(round(altitude / Q_ALT), BITS_ALT))
+
+
+def encode_block(icao, callsign, samples):
+    # samples: [(t, qlat, qlon, qalt)] already quantised, at most MAX_BLOCK_SAMPLES
+    bw = BitWriter()
+    if icao >= ICAO_ESCAPE:
+        # TIS-B and anonymous addresses may use the high bits
+        bw.write(ICAO_ESCAPE, BITS_ICAO)
+        bw.write(icao, BITS_ICAO_FULL)
+    else:
+        bw.write(icao, BITS_ICAO)
+    name = callsign.decode('ascii', 'replace').ljust(CALLSIGN_LEN)[:CALLSIGN_LEN]
+    for c in name:
+        bw.write(CHAR_CODE.get(c, len(CHARSET) - 1), BITS_CHAR)
+    bw.write(len(samples) - 1, BITS_COUNT)
+    t, lat, lon, alt = samples[0]
+    bw.write(t, BITS_T)
+    bw.write_signed(lat, BITS_LAT)
+    bw.write_signed(lon, BITS_LON)
+    bw.write_signed(alt, BITS_ALT)
+    for nt, nlat, nlon, nalt in samples[1:]:
+        bw.write_delta(nt - t, K_DT)
+        bw.write_delta(nlat - lat, K_LATLON)
+        bw.write_delta(nlon - lon, K_LATLON)
+        bw.write_delta(nalt - alt, K_ALT)
+        t, lat, lon, alt = nt, nlat, nlon, nalt
+    return bw.tobytes()
+
+
+def track_blocks(tracks):
+    # tracks: {icao: (callsign, [(t, qlat, qlon, qalt), ...])}
+    for icao, (callsign, samples) in tracks.items():
+        for i in range(0, len(samples), MAX_BLOCK_SAMPLES):
+            yield encode_block(icao, callsign, samples[i:i + MAX_BLOCK_SAMPLES])
+
+
+def pack_blocks(blocks, max_bytes=MAX_FILE_BYTES):
+    # group encoded blocks into file payloads of at most max_bytes
+    files = []
+    group = []
+    size = 3
+    for block in blocks:
+        if group and size + len(block) > max_bytes:
+            files.append(_pack_file(group))
+            group = []
+            size = 3
+        group.append(block)
+        size += len(block)
+    if group:
+        files.append(_pack_file(group))
+    return files
+
+
+def encode_tracks(tracks, max_bytes=MAX_FILE_BYTES):
+    # returns the file payloads for tracks
+    return pack_blocks(track_blocks(tracks), max_bytes)
+
+
+def _pack_file(blocks):
+    return bytes([TRACK_VERSION]) + len(blocks).to_bytes(2, 'little') + b''.join(blocks)
+
+
+def decode_tracks(data, tracks=None):
+    # ground side: returns {icao: {'callsign': str, 'samples': [(t, lat, lon, altitude)]}}
+    # with lat/lon in degE7 and altitude in mm. Pass tracks to merge several files.
+    if tracks is None:
+        tracks = {}
+    version = data[0]
+    if version not in (1, TRACK_VERSION):
+        raise ValueError(f'unknown track version {version}')
+    count = int.from_bytes(data[1:3], 'little')
+    br = BitReader(data[3:])
+    for _ in range(count):
+        icao = br.read(BITS_ICAO)
+        if icao == ICAO_ESCAPE and version >= 2:
+            icao = br.read(BITS_ICAO_FULL)
+        callsign = ''.join(CHARSET[br.read(BITS_CHAR)] for _ in range(CALLSIGN_LEN)).rstrip()
+        n = br.read(BITS_COUNT) + 1
+        t = br.read(BITS_T)
+        lat = br.read_signed(BITS_LAT)
+        lon = br.read_signed(BITS_LON)
+        alt = br.read_signed(BITS_ALT)
+        samples = [(t, lat, lon, alt)]
+        for _ in range(n - 1):
+            t += br.read_delta(K_DT)
+            lat += br.read_delta(K_LATLON)
+            lon += br.read_delta(K_LATLON)
+            alt += br.read_delta(K_ALT)
+            samples.append((t, lat, lon, alt))
+        br.align()
+        track = tracks.setdefault(icao, {'callsign': '', 'samples': []})
+        track['callsign'] = track['callsign'] or callsign
+        track['samples'] += [(t, la * Q_LATLON, lo * Q_LATLON, al * Q_ALT) for t, la, lo, al in samples]
+    return tracks
+
+
+# Keeps one quantised sample per aircraft every interval seconds.
+class TrackLog(object):
+    def __init__(self, interval=5):
+        self.interval = interval
+        self.start = time.time()
+        self.tracks = {}
+
+    def add(self, icao, callsign, lat, lon, altitude):
+        t = min(int(time.time() - self.start), (1 << BITS_T) - 1)
+        name, samples = self.tracks.get(icao, (b'', None))
+        if samples is None:
+            samples = []
+            self.tracks[icao] = (callsign, samples)
+        elif callsign and not name:
+            self.tracks[icao] = (callsign, samples)
+        if samples and t - samples[-1][0] < self.interval:
+            return
+        samples.append((t,) + quantise(lat, lon, altitude))
+
+    def spill(self, icaos, out_fld='.'):
+        # encode the tracks of icaos, append them to the spill file and forget them
+        spilled = {}
+        for icao in icaos:
+            track = self.tracks.pop(int(icao), None)
+            if track is not None:
+                spilled[int(icao)] = track
+        if spilled:
+            with open(os.path.join(out_fld, SPILL_NAME), 'ab') as fbin:
+                for block in track_blocks(spilled):
+                    fbin.write(len(block).to_bytes(2, 'little') + block)
+
+    def _spilled_blocks(self, out_fld):
+        path = os.path.join(out_fld, SPILL_NAME)
+        if not os.path.isfile(path):
+            return []
+        with open(path, 'rb') as fbin:
+            data = fbin.read()
+        os.remove(path)
+        blocks = []
+        pos = 0
+        while pos + 2 <= len(data):
+            end = pos + 2 + int.from_bytes(data[pos:pos + 2], 'little')
+            if end > len(data):
+                break
+            blocks.append(data[pos + 2:end])
+            pos = end
+        return blocks
+
+    def save(self, out_fld='.', max_bytes=MAX_FILE_BYTES):
+        # spilled blocks come first, decode_tracks joins blocks of one ICAO
+        blocks = self._spilled_blocks(out_fld) + list(track_blocks(self.tracks))
+        paths = []
+        for i, payload in enumerate(pack_blocks(blocks, max_bytes)):
+            path = os.path.join(out_fld, f'{TRACK_NAME}_{i}.bin')
+            with open(path, 'wb') as fbin:
+                fbin.write(payload)
+            paths.append(path)
+        return paths
+
+
+if __name__ == "__main__":
+    # round trip, with addresses of 24 bits and more and the escape value itself
+    icaos = (0x000001, 0x738065, ICAO_ESCAPE - 1, ICAO_ESCAPE, 1 << BITS_ICAO, 0xfe123456, 0xffffffff)
+    tracks = {}
+    for i, icao in enumerate(icaos):
+        samples = [(5 * j, *quantise(320000000 + 1000 * i * j, 348000000 - 2000 * j, 10668000 + 7620 * j))
+                   for j in range(3 + i)]
+        tracks[icao] = (b'ELY%03d' % i, samples)
+    decoded = {}
+    for payload in encode_tracks(tracks):
+        decode_tracks(payload, decoded)
+    for icao, (callsign, samples) in tracks.items():
+        track = decoded[icao]
+        assert track['callsign'] == callsign.decode(), (hex(icao), track['callsign'])
+        assert [s[0] for s in track['samples']] == [s[0] for s in samples], hex(icao)
+    assert sorted(decoded) == sorted(icaos)
+    print(f'round trip: {len(icaos)} aircraft, {len(encode_tracks(tracks)[0])} bytes, ok')
@@ -34,3 +34,6 @@ if __name__ == "__main__":
         cmd.append(10)
         print(f'cmd={cmd}')
         cont.msgArrived(cmd)
+        cont.worker.stop()
+        if cont.missionProcess is not None:
+            cont.missionProcess.stop()
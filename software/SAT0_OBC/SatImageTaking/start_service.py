@@ -59,6 +59,9 @@ def main(outputFolder: str, parameters_list: list) -> None:
 
         5: testingOnPreSavedImages (missionID, x, y, quality_factor, gray, vga, img_n) will be able to run the above functions 
           on pre-saved images with a given parameters.
+
+        6: pipeline (missionType, n, n parameters, missionType, ...) will run missions 1-4 one after the other in one
+          uplink, keeping the image in memory, see pipeline.
     """
     global output
     output = outputFolder
@@ -76,6 +79,40 @@ def main(outputFolder: str, parameters_list: list) -> None:
 
     # TODO: continue testing missions: 4,5
 
+    if(missionType == PIPELINE):
+        pipeline(parameters_list[1:])
+        return
+
+    if(missionType not in mission_Table):
+        print(f"Unknown missionType: {missionType}")
+        return
+
+    mission = mission_Table[missionType]
+    mission(*missionArgs(missionType, parameters_list))
+
+    if(missionType == 2):
+        crop_path = f"{output}/Img.jpeg"
+        writeMetaDataSmallImg(crop_path, missionType)
+
+    elif(missionType == 3):
+        icon_path = f"{output}/icon.jpeg"
+        writeMetaDataSmallImg(icon_path, missionType)
+
+    elif(missionType == 4):
+        detected_path = f"{output}/Detected.jpeg"
+        writeMetaDataSmallImg(detected_path, missionType)
+
+
+def missionArgs(missionType: int, parameters_list: list) -> tuple:
+    """Makes the arguments of a mission_Table function from the uplink parameters.
+
+    Args:
+        missionType (int): The mission type, a key of mission_Table.
+        parameters_list (list): The mission parameters, parameters_list[0] is the missionType.
+
+    Returns:
+        tuple: The arguments to call mission_Table[missionType] with.
+    """
     if(missionType == 0 or missionType == 1):
         quality = parameters_list[1] if len(parameters_list) > 1 else 0
         width = (parameters_list[2] * parameters_list[3]
@@ -86,9 +123,7 @@ def main(outputFolder: str, parameters_list: list) -> None:
                    ) if len(parameters_list) > 7 else 0
         ISO = (parameters_list[8] * parameters_list[9]
                ) if len(parameters_list) > 9 else 0
-
-        mission = mission_Table[missionType]
-        mission(quality, width, height, Shutter, ISO)
+        return quality, width, height, Shutter, ISO
 
     elif(missionType == 2):
         mission_count = parameters_list[1] if len(parameters_list) > 1 else 0
@@ -99,12 +134,7 @@ def main(outputFolder: str, parameters_list: list) -> None:
         quality_factor = parameters_list[6] if len(parameters_list) > 6 else 0
         gray = parameters_list[7] if len(parameters_list) > 7 else 0
         qvga = parameters_list[8] if len(parameters_list) > 8 else 1
-
-        mission = mission_Table[missionType]
-        mission(mission_count, x, y, quality_factor, gray, qvga)
-
-        crop_path = f"{output}/Img.jpeg"
-        writeMetaDataSmallImg(crop_path, missionType)
+        return mission_count, x, y, quality_factor, gray, qvga
 
     elif(missionType == 3):
         img_path = parameters_list[1] if len(parameters_list) > 1 else 0
@@ -114,12 +144,7 @@ def main(outputFolder: str, parameters_list: list) -> None:
                   ) if len(parameters_list) > 5 else 0
         quality_factor = parameters_list[6] if len(parameters_list) > 6 else 0
         gray = parameters_list[7] if len(parameters_list) > 7 else 0
-
-        mission = mission_Table[missionType]
-        mission(img_path, width, height, quality_factor, gray)
-
-        icon_path = f"{output}/icon.jpeg"
-        writeMetaDataSmallImg(icon_path, missionType)
+        return img_path, width, height, quality_factor, gray
 
     elif(missionType == 4):
         mission_count = parameters_list[1] if len(parameters_list) > 1 else 0
@@ -130,12 +155,7 @@ def main(outputFolder: str, parameters_list: list) -> None:
         sensitive = parameters_list[6] if len(parameters_list) > 6 else 0
         n_stars = parameters_list[7] if len(parameters_list) > 7 else 0
         with_mask = parameters_list[8] if len(parameters_list) > 8 else 0
-
-        mission = mission_Table[missionType]
-        mission(mission_count, width, height, sensitive, n_stars, with_mask)
-
-        detected_path = f"{output}/Detected.jpeg"
-        writeMetaDataSmallImg(detected_path, missionType)
+        return mission_count, width, height, sensitive, n_stars, with_mask
 
     elif(missionType == 5):
         missionID = parameters_list[1] if len(parameters_list) > 1 else 0
@@ -147,9 +167,86 @@ def main(outputFolder: str, parameters_list: list) -> None:
         gray = parameters_list[7] if len(parameters_list) > 7 else 0
         vga = parameters_list[8] if len(parameters_list) > 8 else 0
         img_n = parameters_list[9] if len(parameters_list) > 9 else 0
+        return x, y, quality_factor, gray, vga, img_n
+
+    raise ValueError(f"unknown missionType {missionType}")
+
+
+def pipeline(stages_list: list) -> None:
+    """Runs several missions of mission_Table one after the other in a single uplink.
+    The image stays in memory from one stage to the next, so a stage that takes a
+    mission_count (2, 4) or an img_path (3) works on the current image when it is 0.
+    A crop (2) with x and y 0 is centered on the brightest star of the last star analysis (4).
+    All the stages write to the same output folder, a later stage replaces the files
+    of the same name.
+
+    Args:
+        stages_list (list): The stages, each one is missionType, n, then the n parameters
+         of that mission as in main (without the missionType). e.g. capture, analyse, crop on
+         the brightest star: 1 0, 4 0, 2 0.
 
-        mission = mission_Table[missionType]
-        mission(x, y, quality_factor, gray, vga, img_n)
+    Returns:
+        None
+    """
+    print("Started pipeline")
+    img = None
+    detected_object = None
+    i = 0
+    while i + 1 < len(stages_list):
+        missionType, n = stages_list[i], stages_list[i + 1]
+        parameters_list = [missionType] + list(stages_list[i + 2: i + 2 + n])
+        i += 2 + n
+        if missionType not in PIPELINE_STAGES:
+            print(f"pipeline: missionType {missionType} can not be a stage, stopped")
+            return
+        args = list(missionArgs(missionType, parameters_list))
+        print(f"pipeline stage {missionType}: {args}")
+
+        if(missionType == 1):
+            img = takePictureWithParameters(*args)
+            continue
+
+        # stages working on an image: the one in memory, or the given mission's
+        if args[0] != 0 or img is None:
+            img = utils.get_image(args[0])
+        args[0] = img
+
+        if(missionType == 2):
+            if args[1] == 0 and args[2] == 0 and detected_object is not None:
+                args[1], args[2] = brightestStar(detected_object, img.shape)
+                print(f"pipeline: crop on the brightest star {args[1]}, {args[2]}")
+            crop_and_compress(*args)
+            writeMetaDataSmallImg(f"{output}/Img.jpeg", missionType)
+
+        elif(missionType == 3):
+            makeIcon(*args)
+            writeMetaDataSmallImg(f"{output}/icon.jpeg", missionType)
+
+        elif(missionType == 4):
+            detected_object = StarAnalysis(*args)
+            writeMetaDataSmallImg(f"{output}/Detected.jpeg", missionType)
+    print("Finished pipeline")
+
+
+def brightestStar(detected_object, shape=None) -> tuple:
+    """Center of the brightest detected star.
+
+    Args:
+        detected_object (star_finder): The star detection of StarAnalysis.
+        shape (tuple, optional): Shape of the image to crop. The center is found in the
+         analysis resolution (width, height of StarAnalysis) and scaled to it.
+
+    Returns:
+        tuple: (x, y) of the brightest star, (0, 0) if no star was found.
+    """
+    if len(detected_object.stars) == 0:
+        return 0, 0
+    star, center, radius, b = max(detected_object.stars, key=lambda star: star[3])
+    x, y = center
+    if shape is not None:
+        height, width = detected_object.gray_image.shape[:2]
+        x, y = x * shape[1] // width, y * shape[0] // height
+    return x, y
 
 
 def TakePhotoStarAnalysis(quality: int, width: int, height: int, Shutter: int, ISO: int) -> None:
@@ -206,7 +303,7 @@ def StarAnalysis(mission_count: int, width=1280, height=720, sensitive=100, n_st
         without_earth_mask (int): Whether or not to use a mask for the Earth (default 0)
 
     Returns:
-            stars_list (list): A list of the detected stars in the image
+            detected_object (star_finder): The star detection, see get_stars
     """
     print("Started StarAnalysis")
     if width == 0:
@@ -237,6 +334,7 @@ def StarAnalysis(mission_count: int, width=1280, height=720, sensitive=100, n_st
     writeMetaDataStars(stars_list)
     print("Starting saveFinalImg")
     saveFinalImg(detected_object.draw_image, "Detected")
+    return detected_object
 
 
 def takeStandardPicture() -> np.ndarray:
@@ -556,3 +654,19 @@ def CompressImage(in_img: np.ndarray, path: str, max_size: int = 16 * LIT.KBYTE,
 
 mission_Table = {0: TakePhotoStarAnalysis, 1: takePictureWithParameters,
                  2: crop_and_compress, 3: makeIcon, 4: StarAnalysis, 5: testing}
+
+# missionType of pipeline, and the missionTypes it can chain
+PIPELINE = 6
+PIPELINE_STAGES = (1, 2, 3, 4)
+
+
+if __name__ == "__main__":
+    # the brightest star found at 640x480 lands on the same spot of a 2592x1944 picture
+    from types import SimpleNamespace
+
+    detected = SimpleNamespace(gray_image=np.zeros((480, 640), np.uint8),
+                               stars=[(None, (100, 50), 3, 10), (None, (320, 240), 2, 90)])
+    assert brightestStar(detected) == (320, 240)
+    assert brightestStar(detected, (1944, 2592, 3)) == (1296, 972), brightestStar(detected, (1944, 2592, 3))
+    assert brightestStar(detected, (480, 640, 3)) == (320, 240)
+    print("brightestStar: ok")
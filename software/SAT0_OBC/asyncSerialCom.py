@@ -0,0 +1,457 @@
+'''
+    @file asyncSerialCom.py
+    @brief asyncio serial transport for SATLLA0 OBC.
+
+    Copyright (C) 2023 @author Rony Ronen
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+import time
+import queue
+import asyncio
+import threading
+
+import serial
+
+from define import *
+from cmdFramer import CmdFramer
+
+EOL = 0x0a
+# A command ends with '\n' followed by EOL_GAP secs of silence, so a 0x0a
+# inside the parameters does not cut it. rpi_mission() waits 100 ms between
+# the parameters and the '\n', so the gap is longer than that, and a last
+# parameter of 0x0a is kept too. The Teensy waits at least 1 sec for a reply
+# before its next command, two commands never come within the gap. A partial
+# command older than STALE secs is dropped.
+EOL_GAP = 0.15
+STALE = 1.0
+READ_CHUNK = 4096
+# what the port does not take at once waits here, a GET_DATA response fits
+WRITE_BUFFER = 32768
+
+# answered on the event loop, every other command goes to the command thread.
+# GET_DATA reads, renames and compresses files, it would hold up GET_STATE.
+QUICK_CMDS = (CmdTypes.CMD_GET_STATE.value, CmdTypes.CMD_POWER_ON.value)
+# the Teensy polls with these, a repeat asks again and is never a resend
+POLL_CMDS = QUICK_CMDS + (CmdTypes.CMD_GET_DATA.value,)
+
+# [global] framing: 'legacy' commands end with '\n', 'crc' commands come in
+# cmdFramer frames. Replies are not framed in either mode.
+FRAMING_LEGACY = 'legacy'
+FRAMING_CRC = 'crc'
+FRAMINGS = (FRAMING_LEGACY, FRAMING_CRC)
+# a mission frame that comes again within this many secs with the same seq
+# is a resend, later the u8 seq may have wrapped around to a new command
+DUPLICATE_SECS = 60
+
+
+# asyncio transport over an open pyserial port, POSIX only (uses the fd).
+class SerialTransport(asyncio.Transport):
+    def __init__(self, loop, ser, protocol):
+        super().__init__()
+        self._loop = loop
+        self._ser = ser
+        self._fd = ser.fileno()
+        self._protocol = protocol
+        # pending output is _out[_start:_end], the buffer is reused
+        self._out = bytearray(WRITE_BUFFER)
+        self._start = 0
+        self._end = 0
+        self._closing = False
+        loop.add_reader(self._fd, self._read_ready)
+        loop.call_soon(protocol.connection_made, self)
+
+    def _read_ready(self):
+        try:
+            data = os.read(self._fd, READ_CHUNK)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._fatal(e)
+            return
+        if data:
+            self._protocol.data_received(data)
+
+    def write(self, data):
+        # data may be a view into a reused buffer, it is not kept after return
+        if self._closing or not data:
+            return
+        data = memoryview(data)
+        if self._start == self._end:
+            try:
+                n = os.write(self._fd, data)
+            except (BlockingIOError, InterruptedError):
+                n = 0
+            except OSError as e:
+                self._fatal(e)
+                return
+            data = data[n:]
+            if not data:
+                return
+            self._start = self._end = 0
+            self._loop.add_writer(self._fd, self._write_ready)
+        self._queue(data)
+
+    def _queue(self, data):
+        end = self._end + len(data)
+        if end > len(self._out):
+            # move the pending bytes to the front, grow only if still short
+            pending = self._end - self._start
+            self._out[:pending] = self._out[self._start:self._end]
+            self._start, self._end = 0, pending
+            end = pending + len(data)
+            if end > len(self._out):
+                self._out.extend(bytes(end - len(self._out)))
+        self._out[self._end:end] = data
+        self._end = end
+
+    def _write_ready(self):
+        try:
+            with memoryview(self._out) as view:
+                n = os.write(self._fd, view[self._start:self._end])
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._fatal(e)
+            return
+        self._start += n
+        if self._start == self._end:
+            self._start = self._end = 0
+            self._loop.remove_writer(self._fd)
+            if self._closing:
+                self._finish(None)
+
+    def get_write_buffer_size(self):
+        return self._end - self._start
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        # sends what is buffered, then closes the port
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.remove_reader(self._fd)
+        if self._start == self._end:
+            self._finish(None)
+
+    def abort(self):
+        self._closing = True
+        self._loop.remove_reader(self._fd)
+        self._finish(None)
+
+    def _fatal(self, exc):
+        print(f'SerialTransport error: {exc}')
+        self._closing = True
+        self._loop.remove_reader(self._fd)
+        self._finish(exc)
+
+    def _finish(self, exc):
+        self._loop.remove_writer(self._fd)
+        self._start = self._end = 0
+        try:
+            self._ser.close()
+        finally:
+            self._loop.call_soon(self._protocol.connection_lost, exc)
+
+
+# Cuts commands out of the byte stream and hands them to AsyncSerialCom.
+class CommandProtocol(asyncio.Protocol):
+    def __init__(self, com, framing=FRAMING_LEGACY):
+        self.com = com
+        self.buf = bytearray()
+        self.timer = None
+        self.last = time.monotonic()
+        # perf_counter() of the last '\n', when the command came in whole
+        self.arrived = None
+        self.framer = CmdFramer() if framing == FRAMING_CRC else None
+        # (seq, payload, time) of the last mission frame. The Teensy asks
+        # GET_STATE before every uplink, so polls are not compared
+        self.lastMission = None
+        self.duplicates = 0
+
+    def connection_made(self, transport):
+        self.com.connected(transport)
+
+    def data_received(self, data):
+        now = time.monotonic()
+        if self.framer is not None:
+            self._frames(data, now)
+            return
+        if self.buf and now - self.last > STALE:
+            print(f'Dropped partial command: {bytes(self.buf)}')
+            self.buf.clear()
+        self.last = now
+        self.buf += data
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.buf[-1] == EOL:
+            self.arrived = time.perf_counter()
+            self.timer = self.com.loop.call_later(EOL_GAP, self._end)
+
+    def _end(self):
+        self.timer = None
+        message = bytes(self.buf)
+        self.buf.clear()
+        if len(message) > 1:
+            self.com.dispatch(message, arrived=self.arrived)
+
+    def _frames(self, data, now):
+        if self.framer.pending() and now - self.last > STALE:
+            print(f'Dropped partial frame: {self.framer.pending()} bytes')
+            self.framer.reset()
+        self.last = now
+        arrived = time.perf_counter()
+        for seq, payload in self.framer.push(data):
+            duplicate = False
+            if payload[0] not in POLL_CMDS:
+                last = self.lastMission
+                duplicate = last is not None and (seq, payload) == last[:2] and now - last[2] < DUPLICATE_SECS
+                self.lastMission = (seq, payload, now)
+            if duplicate:
+                self.duplicates += 1
+            # the controller takes the legacy form, the '\n' is not data here
+            self.com.dispatch(payload + b'\n', duplicate, arrived,
+                              None if payload[0] in POLL_CMDS else (seq, payload))
+
+    def connection_lost(self, exc):
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.framer is not None:
+            print(f'Framing: {self.framer}, duplicates {self.duplicates}')
+        self.com.disconnected(exc)
+
+
+# Same interface as SerialCom. The event loop runs on its own thread; quick
+# commands are answered there, the rest run one at a time on the command
+# thread. Not a concurrent.futures executor: Main.py returns right after
+# Controller(), and executors take no work once the interpreter is shutting down.
+class AsyncSerialCom(object):
+    def __init__(self, controller):
+        self.controller = controller
+        self.loop = None
+        self.transport = None
+        self.commands = queue.Queue()
+        self.commandThread = None
+        self.thread = None
+        self.stopped = None
+        self.started = threading.Event()
+        # (seq, payload) of the mission frame the command thread runs, and the
+        # (seq, payload) and reply of the last one answered, sent again to a resend
+        self.replying = None
+        self.lastReply = None
+
+    # def trigger(self, serialPath='/dev/cu.usbserial-0001', serialSpeed=115200):
+    def trigger(self, serialPath='/dev/serial0', serialSpeed=115200, framing=FRAMING_LEGACY):
+        print(f'trigger()')
+        self.framing = framing
+        self.ser = serial.Serial(serialPath, serialSpeed, timeout=0)  # open serial port
+        print(f'{self.ser.name} started')
+        self.commandThread = threading.Thread(target=self.runCommands)
+        self.commandThread.start()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+        self.started.wait()
+
+    def run(self):
+        print(f'commListener() event loop started')
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+        print("Serial Com completed")
+
+    async def serve(self):
+        self.stopped = self.loop.create_future()
+        SerialTransport(self.loop, self.ser, CommandProtocol(self, self.framing))
+        try:
+            await self.stopped
+        finally:
+            if self.transport is not None:
+                self.transport.close()
+            # the running command may be the one that called finish(),
+            # the ones still queued are dropped
+            while not self.commands.empty():
+                self.commands.get_nowait()
+            self.commands.put(None)
+
+    def connected(self, transport):
+        self.transport = transport
+        self.started.set()
+
+    def disconnected(self, exc):
+        self.transport = None
+        if exc is not None:
+            print(f'Error in commListener(): {exc}')
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+
+    def dispatch(self, message, duplicate=False, arrived=None, frame=None):
+        # arrived: perf_counter() when it came in, the stats count the wait for the command thread
+        # frame: (seq, payload) of a framed command that is not a poll
+        print(f'Message arrived. Message={message}, Size: {len(message)}')
+        if duplicate:
+            # the Teensy resent it since the reply was lost, do not run it twice
+            last = self.lastReply
+            if last is not None and last[0] == frame:
+                print(f'Duplicate frame, reply again: {last[1]}')
+                self.sendMsg(last[1])
+            else:
+                # still running, its reply answers both
+                print(f'Duplicate frame, not answered yet')
+            return
+        if message[0] in QUICK_CMDS:
+            self.controller.msgArrived(message, arrived)
+        else:
+            self.commands.put((message, arrived, frame))
+
+    def runCommands(self):
+        while True:
+            item = self.commands.get()
+            if item is None:
+                break
+            message, arrived, self.replying = item
+            try:
+                self.controller.msgArrived(message, arrived)
+            except:
+                exception_type, exception_object, exception_traceback = sys.exc_info()
+                from traceback import format_tb
+                error = format_tb(exception_traceback)[-1]
+                print()
+                print(exception_type, exception_object, error)
+            self.replying = None
+
+    def finish(self):
+        print(f'finish()')
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._stop)
+
+    def _stop(self):
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+
+    def join(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def sendMsg(self, data):
+        try:
+            print(f'sendMsg(). Size: {len(data)}')
+            if threading.current_thread() is self.thread:
+                # written or queued before returning, data can be a view
+                self.transport.write(data)
+            else:
+                # sent later by the loop, so copy
+                data = bytes(data)
+                if self.replying is not None and threading.current_thread() is self.commandThread:
+                    self.lastReply = (self.replying, data)
+                self.loop.call_soon_threadsafe(self.transport.write, data)
+        except Exception as e:
+            print(e)
+
+
+if __name__ == "__main__":
+    # local stand-in: a pty plays the Teensy and times CMD_GET_STATE answers
+    import pty
+    import select
+    import contextlib
+
+    class StandIn(object):
+        def __init__(self):
+            self.received = []
+            self.answer = ApiTypes.API_ACK.value
+
+        def msgArrived(self, msgByte, arrived=None):
+            self.received.append(msgByte)
+            if msgByte[0] == CmdTypes.CMD_GET_STATE.value:
+                com.sendMsg(bytearray([StateTypes.STATE_READY.value]))
+            else:
+                time.sleep(0.5)
+                com.sendMsg(bytearray([self.answer]))
+
+    def ask(fd, msg):
+        start = time.perf_counter()
+        os.write(fd, msg)
+        select.select([fd], [], [], 2.0)
+        answer = os.read(fd, 100)
+        return answer, (time.perf_counter() - start) * 1000
+
+    master, slave = pty.openpty()
+    stand_in = StandIn()
+    com = AsyncSerialCom(stand_in)
+    com.trigger(serialPath=os.ttyname(slave))
+
+    with open(os.devnull, 'w') as sink, contextlib.redirect_stdout(sink):
+        times = [ask(master, b'\x01\n')[1] for _ in range(50)]
+        # a slow command with 0x0a parameters written at once, GET_STATE is answered meanwhile
+        os.write(master, bytes([CmdTypes.CMD_ADSB.value, 10, 10]) + b'\n')
+        time.sleep(EOL_GAP + 0.05)
+        answer, during = ask(master, b'\x01\n')
+        time.sleep(0.6)
+
+    print(f'GET_STATE: mean {sum(times) / len(times):.2f} ms, max {max(times):.2f} ms')
+    print(f'GET_STATE during a slow command: {answer} in {during:.2f} ms')
+    print(f'Commands: {stand_in.received[-2:]}')
+
+    # a mission whose last parameter is 0x0a, the 0x0a written 100 ms before the '\n' as rpi_mission() does
+    with open(os.devnull, 'w') as sink, contextlib.redirect_stdout(sink):
+        while select.select([master], [], [], 0.1)[0]:
+            os.read(master, 100)
+        mission = bytes([CmdTypes.CMD_ADSB.value, 1, 10])
+        os.write(master, mission)
+        time.sleep(0.1)
+        ack = ask(master, b'\n')[0]
+    print(f'Trailing 0x0a parameter: {stand_in.received[-1]}, ACK {ack}')
+    com.finish()
+    com.join(2.0)
+    print(f'Stopped: {not com.thread.is_alive()}')
+    assert stand_in.received[-1] == mission + b'\n', stand_in.received[-1]
+
+    # framed: a corrupt frame, a 0x0a parameter and a resent frame
+    from cmdFramer import frame
+
+    master, slave = pty.openpty()
+    stand_in = StandIn()
+    com = AsyncSerialCom(stand_in)
+    com.trigger(serialPath=os.ttyname(slave), framing=FRAMING_CRC)
+    with open(os.devnull, 'w') as sink, contextlib.redirect_stdout(sink):
+        times = [ask(master, frame(b'\x01', seq))[1] for seq in range(50)]
+        bad = bytearray(frame(bytes([CmdTypes.CMD_ADSB.value, 10, 10]), 50))
+        bad[5] ^= 0xff
+        os.write(master, bytes(bad) + frame(b'\x01', 51))
+        select.select([master], [], [], 2.0)
+        os.read(master, 100)
+        # resent after a GET_STATE, as rpi_mission() does
+        adsb = frame(bytes([CmdTypes.CMD_ADSB.value, 10, 10]), 52)
+        first = ask(master, adsb)[0]
+        ask(master, frame(b'\x01', 53))
+        again = ask(master, adsb)[0]
+        # a mission answered 0x09 is answered 0x09 again, not ACKed
+        stand_in.answer = ApiTypes.API_NONE.value
+        adsb = frame(bytes([CmdTypes.CMD_ADSB.value, 10, 11]), 54)
+        refused = ask(master, adsb)[0], ask(master, adsb)[0]
+        time.sleep(0.6)
+        com.finish()
+        com.join(2.0)
+    print(f'Framed GET_STATE: mean {sum(times) / len(times):.2f} ms, max {max(times):.2f} ms')
+    print(f'Framed commands: {stand_in.received[-5:]}, ACKs {first} {again}, refused {refused}')
+    assert (first, again) == (b'\x03', b'\x03') and refused == (b'\x09', b'\x09'), (first, again, refused)
+    assert stand_in.received.count(bytes([CmdTypes.CMD_ADSB.value, 10, 11, 10])) == 1
@@ -0,0 +1,91 @@
+'''
+    @file cmdFramer.py
+    @brief CRC-16 framing of the Teensy commands for SATLLA0 OBC.
+
+    Copyright (C) 2023 @author Rony Ronen
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from binascii import crc_hqx
+
+# Frame: sync 0xA5 0x5A, seq u8, len u8, payload (len bytes, the command
+# and its params, no '\n'), crc u16 LE. The crc is CRC-16/CCITT-FALSE
+# (poly 0x1021, init 0xFFFF) over seq, len and payload.
+SYNC = b'\xa5\x5a'
+HEADER_LEN = 4  # sync, seq, len
+CRC_LEN = 2
+MAX_PAYLOAD = 255
+CRC_INIT = 0xffff
+
+
+def crc16(data):
+    return crc_hqx(data, CRC_INIT)
+
+
+def frame(payload, seq=0):
+    # the Teensy side, for the stand-ins and the ground tools
+    body = bytes([seq & 0xff, len(payload)]) + bytes(payload)
+    return SYNC + body + crc16(body).to_bytes(CRC_LEN, 'little')
+
+
+# Cuts frames out of the byte stream. A bad header or crc costs a search
+# for the next sync, the bytes after it are kept, so a good frame right
+# after a corrupt one is not lost.
+class CmdFramer(object):
+    def __init__(self):
+        self.buf = bytearray()
+        # counters, printed when the link closes
+        self.frames = 0
+        self.crc_errors = 0
+        self.resyncs = 0
+
+    def pending(self):
+        return len(self.buf)
+
+    def reset(self):
+        self.buf.clear()
+
+    def push(self, data):
+        # yields (seq, payload) of every good frame after adding data
+        self.buf += data
+        buf = self.buf
+        while len(buf) >= HEADER_LEN:
+            if buf[0] != SYNC[0] or buf[1] != SYNC[1]:
+                self._resync(1)
+                continue
+            length = buf[3]
+            if length == 0:
+                self._resync(1)
+                continue
+            end = HEADER_LEN + length + CRC_LEN
+            if len(buf) < end:
+                break
+            if crc16(buf[2:end - CRC_LEN]) != int.from_bytes(buf[end - CRC_LEN:end], 'little'):
+                self.crc_errors += 1
+                self._resync(1)
+                continue
+            seq, payload = buf[2], bytes(buf[HEADER_LEN:end - CRC_LEN])
+            del buf[:end]
+            self.frames += 1
+            yield seq, payload
+
+    def _resync(self, start):
+        # drop bytes up to the next sync byte after start
+        self.resyncs += 1
+        idx = self.buf.find(SYNC[0], start)
+        del self.buf[:idx if idx >= 0 else len(self.buf)]
+
+    def __str__(self):
+        return f'frames {self.frames}, crc errors {self.crc_errors}, resyncs {self.resyncs}'
@@ -0,0 +1,164 @@
+'''
+    @file cmdStats.py
+    @brief Command latency and mission phase telemetry for SATLLA0 OBC.
+
+    Copyright (C) 2023 @author Aharon Gorodischer
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import time
+import struct
+import threading
+from contextlib import contextmanager
+
+STATS_NAME = '_cmdstats.bin'
+STATS_VERSION = 1
+
+# Latency histogram, log2 buckets in microseconds: bucket 0 is < 64 us,
+# bucket k is [2^(k+5), 2^(k+6)) us, the last bucket takes 1 s and more.
+BUCKETS = 16
+BUCKET_SHIFT = 5
+
+# File layout, little-endian:
+#   version u8, boot u16, uptime secs u32, mission u16, commands u8, phases u8
+#   per command: cmd u8, count u32, total us u64, max us u32,
+#                replies u32, reply total us u64, reply max us u32, BUCKETS x u16
+#   per phase of mission: name length u8, name, secs f32
+HEADER = struct.Struct('<BHIHBB')
+COMMAND = struct.Struct(f'<BIQIIQI{BUCKETS}H')
+PHASE = struct.Struct('<f')
+
+MAX_U16 = 0xffff
+MAX_U32 = 0xffffffff
+
+
+def bucket(us):
+    return min(max(us.bit_length() - BUCKET_SHIFT, 0), BUCKETS - 1)
+
+
+# Counts and times every command from its arrival on the link to the
+# return of msgArrived, and to its first reply, so the wait for the command
+# thread is included. begin/end are per thread since quick and slow
+# commands run on different threads.
+class CommandStats(object):
+    def __init__(self, boot=0):
+        self.boot = boot
+        self.start = time.time()
+        self.lock = threading.Lock()
+        # cmd: [count, total us, max us, replies, reply total us, reply max us, histogram]
+        self.commands = {}
+        # mission: [(phase name, secs)]
+        self.phases = {}
+        self.local = threading.local()
+
+    def _record(self, command):
+        rec = self.commands.get(command)
+        if rec is None:
+            rec = self.commands[command] = [0, 0, 0, 0, 0, 0, [0] * BUCKETS]
+        return rec
+
+    def begin(self, command, arrived=None):
+        # arrived: time.perf_counter() when the command came in, else now
+        self.local.command = command
+        self.local.replied = False
+        self.local.start = time.perf_counter() if arrived is None else arrived
+
+    def replied(self):
+        # first reply of the running command, the ACK of a mission
+        if getattr(self.local, 'start', None) is None or self.local.replied:
+            return
+        self.local.replied = True
+        us = int((time.perf_counter() - self.local.start) * 1e6)
+        with self.lock:
+            rec = self._record(self.local.command)
+            rec[3] += 1
+            rec[4] += us
+            rec[5] = max(rec[5], us)
+
+    def end(self):
+        if getattr(self.local, 'start', None) is None:
+            return
+        us = int((time.perf_counter() - self.local.start) * 1e6)
+        self.local.start = None
+        with self.lock:
+            rec = self._record(self.local.command)
+            rec[0] += 1
+            rec[1] += us
+            rec[2] = max(rec[2], us)
+            rec[6][bucket(us)] += 1
+
+    # --------------------------
+    # mission phases
+    def addPhase(self, mission, name, secs):
+        with self.lock:
+            self.phases.setdefault(mission, []).append((name, secs))
+
+    @contextmanager
+    def phase(self, mission, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addPhase(mission, name, time.perf_counter() - start)
+
+    # --------------------------
+    def pack(self, mission=0):
+        # all commands so far and the phases of mission
+        with self.lock:
+            commands = sorted(self.commands.items())
+            phases = self.phases.pop(mission, [])
+        uptime = min(int(time.time() - self.start), MAX_U32)
+        data = [HEADER.pack(STATS_VERSION, self.boot & MAX_U16, uptime, mission & MAX_U16,
+                            len(commands), len(phases))]
+        for command, (count, total, top, replies, reply_total, reply_top, hist) in commands:
+            data.append(COMMAND.pack(command & 0xff, min(count, MAX_U32), total, min(top, MAX_U32),
+                                     min(replies, MAX_U32), reply_total, min(reply_top, MAX_U32),
+                                     *(min(n, MAX_U16) for n in hist)))
+        for name, secs in phases:
+            name = name.encode()[:255]
+            data.append(bytes([len(name)]) + name + PHASE.pack(secs))
+        return b''.join(data)
+
+    def save(self, folder, mission=0, name=STATS_NAME):
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, name)
+        with open(path, 'wb') as fbin:
+            fbin.write(self.pack(mission))
+        return path
+
+
+def load(path):
+    # ground side: returns (header dict, {cmd: dict}, [(phase, secs)])
+    with open(path, 'rb') as fbin:
+        data = fbin.read()
+    version, boot, uptime, mission, ncommands, nphases = HEADER.unpack_from(data, 0)
+    header = {'version': version, 'boot': boot, 'uptime': uptime, 'mission': mission}
+    pos = HEADER.size
+    commands = {}
+    for _ in range(ncommands):
+        fields = COMMAND.unpack_from(data, pos)
+        pos += COMMAND.size
+        commands[fields[0]] = {'count': fields[1], 'total_us': fields[2], 'max_us': fields[3],
+                               'replies': fields[4], 'reply_total_us': fields[5],
+                               'reply_max_us': fields[6], 'hist': list(fields[7:])}
+    phases = []
+    for _ in range(nphases):
+        n = data[pos]
+        name = data[pos + 1:pos + 1 + n].decode()
+        secs = PHASE.unpack_from(data, pos + 1 + n)[0]
+        pos += 1 + n + PHASE.size
+        phases.append((name, secs))
+    return header, commands, phases
@@ -21,14 +21,17 @@
 
 import os
 import sys
-import serialCom
+import asyncSerialCom
 import subprocess
 import configparser
 import msgGenerator
+import missionWorker
+import missionProcess
+import counterStore
+import cmdStats
+import prewarm
 from time import time as time_time
 
-from TakePicSmart import take_pic_smart
-
 from define import *
 
 cfg_file = "config.conf"
@@ -40,9 +43,15 @@ class Controller:
     generator = msgGenerator.MsgGenerator()
     config.read(cfg_file)
     state = StateTypes.STATE_BUSY.value
+    missionProcess = None
 
     def __init__(self, mode=0):
         print("Controller Class __ init__")
+        # a typo here would leave the link in a mode the Teensy does not speak
+        framing = config.get("global", "framing", fallback=asyncSerialCom.FRAMING_LEGACY)
+        if framing not in asyncSerialCom.FRAMINGS:
+            raise ValueError(f"[global] framing = {framing}, expected one of {', '.join(asyncSerialCom.FRAMINGS)}")
+
         print("Create Outbox folder")
         if not os.path.exists("./outbox/"):
             try:
@@ -57,25 +66,92 @@ class Controller:
             except Exception as e:
                 print(e)
 
+        # counters live in counters.bin, config.conf values only seed a new one
+        print("Open counters")
+        seed = {}
+        for section, name in (("global", "bootCount"), ("mission", "missionCount"),
+                              ("mission", "picCount"), ("mission", "fileCount")):
+            if config.has_option(section, name):
+                seed[name] = config.get(section, name)
+        # missions already in outbox/ or sent/ keep their numbers
+        missions = [int(e.name) for folder in ("./outbox", "./sent") if os.path.isdir(folder)
+                    for e in os.scandir(folder) if e.is_dir() and e.name.isdigit()]
+        if missions:
+            seed["missionCount"] = max(int(seed.get("missionCount", 0)), max(missions) + 1)
+        self.counters = counterStore.CounterStore(counterStore.COUNTERS_FILE, seed)
+
+        # update boot count
+        print("Update boot count")
+        bootCount = self.counters.next("bootCount") + 1
+        # command latency and mission phases, saved to the outbox
+        self.stats = cmdStats.CommandStats(bootCount)
+
+        # downlink: chunked GET_DATA and file order
+        self.generator.fileCount = self.counters.get("fileCount")
+        try:
+            self.chunkSize = int(config.get("downlink", "chunkSize"))
+        except Exception as e:
+            print(e)
+            self.chunkSize = msgGenerator.CHUNK_SIZE
+        self.chunkSize = min(self.chunkSize, msgGenerator.LEGACY_MAX - msgGenerator.CHUNK_HEADER_LEN - 1)
+        try:
+            self.generator.compress = config.getboolean("downlink", "compress", fallback=False)
+        except Exception as e:
+            print(e)
+        try:
+            self.generator.outbox.setPriority(config.get("downlink", "priority").split(','))
+        except Exception as e:
+            print(e)
+
+        # ADS-B logs of missions that did not end, before they are indexed
+        print("Compact ADS-B logs")
+        try:
+            from ADSB import adsb_log
+            adsb_log.recover("./outbox")
+        except Exception as e:
+            print(e)
+
+        print("Index Outbox folder")
+        self.generator.outbox.rebuild()
+
+        # missions run here, the serial thread only answers and queues
+        print("Init mission worker")
+        try:
+            queueSize = int(config.get("worker", "queueSize"))
+        except Exception as e:
+            print(e)
+            queueSize = 4
+        self.worker = missionWorker.MissionWorker(queueSize, done=self.missionDone)
+        try:
+            self.workerStopTimeout = float(config.get("worker", "stopTimeout"))
+        except Exception as e:
+            print(e)
+            self.workerStopTimeout = 20
+
         # init serial with teensy
         print("Init serial com")
         try:
-            self.serial = serialCom.SerialCom(self)
+            self.serial = asyncSerialCom.AsyncSerialCom(self)
             serial_path = config.get("global", "serialPath")
             # '/dev/cu.usbserial-0001'
-            self.serial.trigger(serialPath=serial_path)
+            self.serial.trigger(serialPath=serial_path, framing=framing)
         except Exception as e:
             print(e)
 
-        # update boot count
-        print("Update boot count")
+        # image missions run in their own process, its imports wait for no one:
+        # the link answers meanwhile, a mission waits for them in call()
+        print("Start mission process")
         try:
-            bootCount = int(config.get("global", "bootCount")) + 1
-            # resetLogFactor = int(config.get("global", "resetLogFactor"))
-            config.set("global", "bootCount", str(bootCount))
+            if config.getboolean("missionProcess", "enabled", fallback=True):
+                modules = [m.strip() for m in config.get("missionProcess", "modules").split(",") if m.strip()]
+                self.missionProcess = missionProcess.MissionProcess(
+                    modules,
+                    int(config.get("missionProcess", "maxRss")) * 1024 * 1024,
+                    int(config.get("missionProcess", "timeout")),
+                    self.stats).startLater()
         except Exception as e:
             print(e)
-        self.saveConfigFile()
+            self.missionProcess = None
 
         # empty log each resetLogFactor times (default is 10)
         # try:
@@ -91,18 +167,43 @@ class Controller:
         # except Exception as e:
         #     print(e)
 
-        self.state = StateTypes.STATE_READY.value
-        print(f"Controller initiated. State: {StateTypes.STATE_READY.value}")
-
-    def saveConfigFile(self):
-        print("saveConfigFile()")
+        # the link answers already, import the mission libraries meanwhile
+        print("Prewarm imports")
         try:
-            with open(cfg_file, "w") as configfile:
-                config.write(configfile)
+            modules = [m.strip() for m in config.get("startup", "prewarm").split(",") if m.strip()]
+            delay = float(config.get("startup", "prewarmDelay"))
         except Exception as e:
             print(e)
+            modules, delay = prewarm.PREWARM, 0
+        self.prewarmer = prewarm.Prewarmer(modules, self.stats, delay).start()
+
+        self.state = StateTypes.STATE_READY.value
+        print(f"Controller initiated. State: {StateTypes.STATE_READY.value}")
 
-    def msgArrived(self, msgByte):
+    def msgArrived(self, msgByte, arrived=None):
+        # times each command from arrived (time.perf_counter()), see cmdStats
+        self.stats.begin(msgByte[0] if len(msgByte) > 1 else CmdTypes.CMD_NONE.value, arrived)
+        try:
+            self.handleMsg(msgByte)
+        finally:
+            self.stats.end()
+
+    def reply(self, data):
+        self.stats.replied()
+        self.serial.sendMsg(data)
+
+    def hasData(self):
+        # outbox files or a chunked transfer not finished yet
+        return self.generator.current is not None or self.generator.outbox.hasData()
+
+    def noData(self):
+        # nothing to send. 0x00 ends the Teensy's GET_DATA loop and powers us off,
+        # so while a mission is queued or running answer pending, it asks again
+        if self.worker.busy():
+            return ApiTypes.API_PENDING.value
+        return ApiTypes.API_NO_DATA.value
+
+    def handleMsg(self, msgByte):
         print("msgArrived()")
         try:
             print(f"Message arrived: {msgByte}")
@@ -117,16 +218,35 @@ class Controller:
 
             if command == CmdTypes.CMD_GET_STATE.value:  # 1
                 print("called CmdTypes.CMD_GET_STATE")
-                self.serial.sendMsg(bytearray([self.state]))
+                # busy only while a mission is queued or running and there is nothing to send:
+                # on Ready the Teensy asks GET_DATA, GET_DATA answers pending until the mission ends
+                state = self.state
+                if self.worker.busy() and not self.hasData():
+                    state = StateTypes.STATE_BUSY.value
+                self.reply(bytearray([state]))
+
+            elif command == CmdTypes.CMD_GET_DATA.value and paramsListLen > 1 and paramsList[1] == 1:  # 2, chunked
+                print("*** CmdTypes.CMD_GET_DATA chunked ***")
+                # params: mode (1), optional file id (2 bytes LE) and offset (4 bytes LE)
+                file_id = offset = None
+                if paramsListLen >= 8:
+                    file_id = int.from_bytes(paramsList[2:4], 'little')
+                    offset = int.from_bytes(paramsList[4:8], 'little')
+                fileCount = self.generator.fileCount
+                frame = self.generator.readChunk(file_id=file_id, offset=offset, size=self.chunkSize)
+                if self.generator.fileCount != fileCount:
+                    self.counters.set(fileCount=self.generator.fileCount)
+                if frame is not None:
+                    self.reply(frame)
+                else:
+                    self.reply(bytearray([self.noData()]))
 
             elif command == CmdTypes.CMD_GET_DATA.value:  # 2
                 print("*** CmdTypes.CMD_GET_DATA ***")
                 mission, file_type, data = self.generator.readMsg()
                 # print (f'Send data: {data}')
+                # UART buffer size is 2^14, readMsg leaves larger files for chunks
                 if len(data) > 0:
-                    # UART buffer size is 2^14
-                    if len(data) >= 16384:
-                        return
                     # send the length
                     try:
                         header = mission.to_bytes(
@@ -134,57 +254,37 @@ class Controller:
                     except:
                         header = b"000"
                     print(f'Header: {header}')
-                    data = header + data
-                    self.serial.sendMsg(data)
+                    self.reply(self.generator.frame(header, len(data)))
                 else:
-                    self.serial.sendMsg(
-                        bytearray([ApiTypes.API_NO_DATA.value]))
+                    self.reply(bytearray([self.noData()]))
 
             elif command == CmdTypes.CMD_POWER_ON.value:  # 3
                 print("called CmdTypes.CMD_POWER_ON")
-                self.serial.sendMsg(bytearray([ApiTypes.API_ACK.value]))
+                self.reply(bytearray([ApiTypes.API_ACK.value]))
 
             elif command == CmdTypes.CMD_TAKE_PHOTO.value:  # 4
                 print("*** CmdTypes.CMD_TAKE_PHOTO ***")
-                self.state = StateTypes.STATE_BUSY.value
-                self.serial.sendMsg(bytearray([ApiTypes.API_ACK.value]))
+                if self.worker.full():
+                    self.reply(bytearray([ApiTypes.API_NONE.value]))
+                    return
 
                 # update indexes
-                picCount = int(config.get("mission", "picCount"))
-                missionCount = int(config.get("mission", "missionCount"))
-                config.set("mission", "missionCount", str(missionCount + 1))
-                config.set("mission", "picCount", str(picCount + 1))
-                self.saveConfigFile()
+                missionCount, picCount = self.counters.next("missionCount", "picCount")
 
                 # set parameters
                 width = paramsList[1] if paramsListLen > 1 else 100
                 # mode: 1 = Day, 2 = Night,
                 mode = paramsList[2] if paramsListLen > 2 else 1
 
-                print(
-                    f'take_pic_smart(missionCount={missionCount}, picCount={picCount}, width={width}, mode={mode})')
-
-                take_pic_smart(missionCount, picCount, width, mode)
-
-                # set ready
-                self.state = StateTypes.STATE_READY.value
-                print("*** CmdTypes.CMD_TAKE_PHOTO Done ***")
+                self.queueMission(missionCount, self.runTakePhoto, missionCount, picCount, width, mode)
 
             elif command == CmdTypes.CMD_ADSB.value:  # 14 ADSB log
                 print("*** CmdTypes.CMD_ADSB ***")
-                self.state = StateTypes.STATE_BUSY.value
-
-                self.serial.sendMsg(bytearray([ApiTypes.API_ACK.value]))
-
-                missionCount = int(config.get("mission", "missionCount"))
-                config.set("mission", "missionCount", str(missionCount + 1))
-                self.saveConfigFile()
+                if self.worker.full():
+                    self.reply(bytearray([ApiTypes.API_NONE.value]))
+                    return
 
-                import RPi.GPIO as GPIO
-                gpio_fet_pin = int(config.get("RWCS", "gpio_fet_pin"))
-                GPIO.setmode(GPIO.BCM)
-                GPIO.setup(gpio_fet_pin, GPIO.OUT)
-                GPIO.output(gpio_fet_pin, GPIO.HIGH)
+                missionCount = self.counters.next("missionCount")
 
                 # make mission folder
                 out_fld = f"./outbox/{missionCount}"
@@ -193,22 +293,23 @@ class Controller:
 
                 # set parameters
                 timeout = paramsList[1] if paramsListLen > 1 else 60
+                # early stop: aircraft to collect, idle secs. 0 = use ADSB/config.conf
+                max_icao = paramsList[2] if paramsListLen > 2 and paramsList[2] > 0 else None
+                idle = paramsList[3] if paramsListLen > 3 and paramsList[3] > 0 else None
 
-                print(f'adsb_listener(out_fld={out_fld}, timeout={timeout})')
-
-                from ADSB import adsb_listener
-                adsb_listener.run(out_fld, timeout)
-
-                GPIO.output(gpio_fet_pin, GPIO.LOW)
-
-                self.state = StateTypes.STATE_READY.value
-                print("*** CmdTypes.CMD_RWCS Done ***")
+                self.queueMission(missionCount, self.runAdsb, missionCount, out_fld, timeout, max_icao, idle)
 
             elif command == CmdTypes.CMD_POWER_OFF.value:  # 8
                 print("*** CmdTypes.CMD_POWER_OFF ***")
-                self.serial.sendMsg(bytearray([ApiTypes.API_ACK.value]))  # 8
+                self.reply(bytearray([ApiTypes.API_ACK.value]))  # 8
                 # here we should start power off
                 self.serial.finish()
+                # finish the queued missions first, but not for long: the Teensy
+                # cuts the power 4 minutes after it turned us on
+                self.worker.stop(self.workerStopTimeout)
+                if self.missionProcess is not None:
+                    self.missionProcess.stop()
+                self.stats.save("./outbox", 0, f"_cmdstats_boot{self.stats.boot}.bin")
                 # self.log.close()
                 subprocess.call(["sudo", "shutdown", "now"])
 
@@ -216,7 +317,7 @@ class Controller:
 
             elif command == CmdTypes.CMD_DROP_OUTBOX.value:  # 9
                 print("*** CmdTypes.CMD_DROP_OUTBOX ***")
-                self.serial.sendMsg(bytearray([ApiTypes.API_ACK.value]))
+                self.reply(bytearray([ApiTypes.API_ACK.value]))
 
                 self.generator.dropAllMessages(folderName='outbox')
                 mode = paramsList[1] if paramsListLen > 1 else 0
@@ -225,16 +326,14 @@ class Controller:
                 print("*** CmdTypes.CMD_DROP_OUTBOX Done ***")
 
             elif command == CmdTypes.CMD_NEW_TAKE_PHOTO.value:  # 15
-                start_time = time_time()
-                # set state to in mission and sendmsg
+                # queue the mission and sendmsg
                 print("*** CmdTypes.CMD_NEW_TAKE_PHOTO ***")
-                self.state = StateTypes.STATE_BUSY.value
-                self.serial.sendMsg(bytearray([ApiTypes.API_ACK.value]))
+                if self.worker.full():
+                    self.reply(bytearray([ApiTypes.API_NONE.value]))
+                    return
 
                 # get mission id
-                missionCount = int(config.get("mission", "missionCount"))
-                config.set("mission", "missionCount", str(missionCount + 1))
-                self.saveConfigFile()
+                missionCount = self.counters.next("missionCount")
 
                 # check for mission folder and create if needed
                 out_fld = f"./outbox/{missionCount}"
@@ -242,27 +341,18 @@ class Controller:
                     os.makedirs(out_fld, exist_ok=True)
 
                 # execute mission with parameters:
-                from SatImageTaking import start_service
-                print("Started start_service main")
-                start_service.main(out_fld, paramsList[1:])
-                print("Finished start_service main")
-                # finished executing mission:
-                self.state = StateTypes.STATE_READY.value
-                print("*** CmdTypes.CMD_NEW_TAKE_PHOTO Done ***")
-                end_time = (time_time() - start_time)
-                print(f"Time taken to execute mission: {end_time}")
+                self.queueMission(missionCount, self.runNewTakePhoto, missionCount, out_fld, paramsList[1:])
 
             elif command == CmdTypes.CMD_UPLOAD_FILE.value:  # 16
                 print("*** CmdTypes.CMD_UPLOAD_FILE ***")
                 
-                # set state to in mission and sendmsg
-                self.state = StateTypes.STATE_BUSY.value
-                self.serial.sendMsg(bytearray([ApiTypes.API_ACK.value]))
+                # queue the mission and sendmsg
+                if self.worker.full():
+                    self.reply(bytearray([ApiTypes.API_NONE.value]))
+                    return
 
                 # get mission id
-                missionCount = int(config.get("mission", "missionCount")) #TODO
-                config.set("mission", "missionCount", str(missionCount + 1))
-                self.saveConfigFile()
+                missionCount = self.counters.next("missionCount") #TODO
 
                 # check for mission folder and create if needed
                 out_fld = f"./outbox/{missionCount}"
@@ -282,15 +372,10 @@ class Controller:
                 print('parms: * > * > ' , f'missionCount: {missionCount}, scriptNum: {scriptNum}, ', end='') 
                 print(f'line_num: {line_num}, num_chars: {num_chars}, txt: {repr(txt)}, reset: {reset}')
         
-                import uploading
-                uploading.main(missionCount, scriptNum, line_num, txt, reset)
-                
-                # finished executing mission:
-                self.state = StateTypes.STATE_READY.value
-                print("*** CmdTypes.CMD_UPLOAD_FILE Done ***")
+                self.queueMission(missionCount, self.runUploadFile, missionCount, scriptNum, line_num, txt, reset)
             else:
                 print(f'*** Command Unknown: {command} ***')
-                self.serial.sendMsg(bytearray([ApiTypes.API_ACK.value]))
+                self.reply(bytearray([ApiTypes.API_ACK.value]))
 
         except:  # msgArrived
             exception_type, exception_object, exception_traceback = sys.exc_info()
@@ -300,7 +385,86 @@ class Controller:
             print(exception_type, exception_object, error)
 
             self.state = StateTypes.STATE_READY.value
-            # self.serial.sendMsg(bytearray([self.MISSION_ERR]))
+            # self.reply(bytearray([self.MISSION_ERR]))
+
+    # --------------------------
+    # missions, run on the MissionWorker thread
+    def queueMission(self, missionCount, func, *args):
+        # times the wait in the queue and the run of the mission
+        queued = time_time()
+
+        def run():
+            self.stats.addPhase(missionCount, "queue", time_time() - queued)
+            with self.stats.phase(missionCount, "run"):
+                func(*args)
+        # not downlinked before it ends, missionDone() adds it to the index
+        self.generator.outbox.hold(missionCount)
+        if not self.worker.submit(missionCount, run):
+            self.generator.outbox.addMission(missionCount)
+            self.reply(bytearray([ApiTypes.API_NONE.value]))
+            return False
+        # ACK once queued: the GET_STATE that follows must already see it busy
+        self.reply(bytearray([ApiTypes.API_ACK.value]))
+        return True
+
+    def missionDone(self, mission):
+        # the phase telemetry goes down with the mission files
+        try:
+            self.stats.save(f"./outbox/{mission}", mission)
+        except Exception as e:
+            print(e)
+        self.generator.outbox.addMission(mission)
+
+    def runTakePhoto(self, missionCount, picCount, width, mode):
+        print(
+            f'take_pic_smart(missionCount={missionCount}, picCount={picCount}, width={width}, mode={mode})')
+
+        if self.missionProcess is not None:
+            self.missionProcess.call(missionCount, "take_pic_smart", missionCount, picCount, width, mode)
+        else:
+            with self.stats.phase(missionCount, "import"):
+                from TakePicSmart import take_pic_smart
+            take_pic_smart(missionCount, picCount, width, mode)
+        print("*** CmdTypes.CMD_TAKE_PHOTO Done ***")
+
+    def runAdsb(self, missionCount, out_fld, timeout, max_icao, idle):
+        import RPi.GPIO as GPIO
+        gpio_fet_pin = int(config.get("RWCS", "gpio_fet_pin"))
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(gpio_fet_pin, GPIO.OUT)
+        GPIO.output(gpio_fet_pin, GPIO.HIGH)
+
+        print(f'adsb_listener(out_fld={out_fld}, timeout={timeout}, max_icao={max_icao}, idle={idle})')
+
+        try:
+            with self.stats.phase(missionCount, "import"):
+                from ADSB import adsb_listener
+            with self.stats.phase(missionCount, "listen"):
+                adsb_listener.run(out_fld, timeout, max_icao=max_icao, idle=idle)
+        finally:
+            GPIO.output(gpio_fet_pin, GPIO.LOW)
+        print("*** CmdTypes.CMD_ADSB Done ***")
+
+    def runNewTakePhoto(self, missionCount, out_fld, params):
+        start_time = time_time()
+        print("Started start_service main")
+        if self.missionProcess is not None:
+            with self.stats.phase(missionCount, "service"):
+                self.missionProcess.call(missionCount, "start_service", out_fld, list(params))
+        else:
+            with self.stats.phase(missionCount, "import"):
+                from SatImageTaking import start_service
+            with self.stats.phase(missionCount, "service"):
+                start_service.main(out_fld, params)
+        print("Finished start_service main")
+        print("*** CmdTypes.CMD_NEW_TAKE_PHOTO Done ***")
+        end_time = (time_time() - start_time)
+        print(f"Time taken to execute mission: {end_time}")
+
+    def runUploadFile(self, missionCount, scriptNum, line_num, txt, reset):
+        import uploading
+        uploading.main(missionCount, scriptNum, line_num, txt, reset)
+        print("*** CmdTypes.CMD_UPLOAD_FILE Done ***")
 
 if __name__ == "__main__":
     print(f'*** Controller() Started ***')
@@ -311,3 +475,6 @@ if __name__ == "__main__":
             cmd = chr(int(c))
             cmd = str(cmd) + '\n'
             cont.msgArrived(cmd.encode())
+        cont.worker.stop()
+        if cont.missionProcess is not None:
+            cont.missionProcess.stop()
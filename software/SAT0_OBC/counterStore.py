@@ -0,0 +1,97 @@
+'''
+    @file counterStore.py
+    @brief Power-safe persistent counters for SATLLA0 OBC.
+
+    Copyright (C) 2023 @author Aharon Gorodischer
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import zlib
+import struct
+import threading
+
+COUNTERS_FILE = 'counters.bin'
+# order is the record layout, add new names at the end only
+COUNTERS = ('bootCount', 'missionCount', 'picCount', 'fileCount')
+
+# The file holds two slots of: seq (u32), counters (u32 each), crc32 (u32).
+# Every update writes the older slot with seq + 1 and fsyncs it, so a power
+# cut can tear at most the slot being written and the other one is still
+# valid. Loading takes the valid slot with the higher seq.
+RECORD = struct.Struct(f'<I{len(COUNTERS)}I')
+SLOT_LEN = RECORD.size + 4
+
+
+class CounterStore(object):
+    def __init__(self, path=COUNTERS_FILE, seed=None):
+        # seed: {name: value} used when the file does not exist yet
+        self.path = path
+        self.lock = threading.Lock()
+        self.values = dict.fromkeys(COUNTERS, 0)
+        self.seq = 0
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if not self.load():
+            print(f'CounterStore: new {path}')
+            for name, value in (seed or {}).items():
+                if name in self.values:
+                    self.values[name] = int(value)
+            self.write()
+
+    def load(self):
+        data = os.pread(self.fd, 2 * SLOT_LEN, 0)
+        best = None
+        for i in range(2):
+            slot = data[i * SLOT_LEN:(i + 1) * SLOT_LEN]
+            if len(slot) < SLOT_LEN:
+                continue
+            record, crc = slot[:RECORD.size], struct.unpack_from('<I', slot, RECORD.size)[0]
+            if zlib.crc32(record) != crc:
+                continue
+            fields = RECORD.unpack(record)
+            if best is None or (fields[0] - best[0]) & 0xffffffff < 0x80000000:
+                best = fields
+        if best is None:
+            return False
+        self.seq = best[0]
+        self.values = dict(zip(COUNTERS, best[1:]))
+        print(f'CounterStore: {self.values}')
+        return True
+
+    def write(self):
+        self.seq = (self.seq + 1) & 0xffffffff
+        record = RECORD.pack(self.seq, *(self.values[name] & 0xffffffff for name in COUNTERS))
+        os.pwrite(self.fd, record + struct.pack('<I', zlib.crc32(record)), (self.seq & 1) * SLOT_LEN)
+        os.fsync(self.fd)
+
+    def get(self, name):
+        return self.values[name]
+
+    def set(self, **values):
+        with self.lock:
+            self.values.update(values)
+            self.write()
+
+    def next(self, *names):
+        # returns the current value(s) to use and stores them + 1, in one write
+        with self.lock:
+            current = [self.values[name] for name in names]
+            for name in names:
+                self.values[name] += 1
+            self.write()
+        return current[0] if len(current) == 1 else current
+
+    def close(self):
+        os.close(self.fd)
@@ -30,6 +30,7 @@ class StateTypes(Enum):
 # Interface Types
 class ApiTypes(Enum):
     API_NO_DATA = 0
+    API_PENDING = 1
     API_ACK = 3
     API_NONE = 9
 
@@ -0,0 +1,215 @@
+'''
+    @file downlinkCodec.py
+    @brief Compression of the GET_DATA payloads for SATLLA0 OBC.
+
+    Copyright (C) 2023 @author Aharon Gorodischer
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import zlib
+import struct
+
+from define import DataTypes
+
+# Set on the file type byte of the response header when the data is
+# compressed. File types (DataTypes and pyramid levels) are all below it.
+COMPRESSED = 0x80
+
+# Compressed data: dictionary id (u8), then a raw deflate stream made with
+# that preset dictionary. The ground needs the same dictionaries, so a
+# dictionary is never changed once flown, a new one gets a new id.
+DICT_NONE = 0
+DICT_ADSB = 1
+DICT_TEXT = 2
+
+# types worth trying, images are compressed already. META stays raw: the
+# Teensy checks its type byte and parses it (save_meta_file, mission index)
+COMPRESS_TYPES = (DataTypes.OTHER.value, DataTypes.STARS.value, DataTypes.TEXT.value,
+                  DataTypes.DATA.value, DataTypes.STD_OUT.value, DataTypes.STD_ERR.value,
+                  DataTypes.LASER_TEXT.value)
+# JPEG, JPEG 2000 (box and codestream) and PNG, skipped whatever their type.
+# The extension covers the chunks after the first one, which have no magic.
+MAGIC = (b'\xff\xd8\xff', b'\x00\x00\x00\x0cjP  ', b'\xff\x4f\xff\x51', b'\x89PNG')
+IMAGE_EXT = ('.jpg', '.jpeg', '.jp2', '.j2k', '.png')
+# below this the dictionary id and the deflate end cost more than they save
+MIN_SIZE = 24
+LEVEL = 9
+
+
+def adsbDict():
+    # the ADS-B outputs: ADSB_VEHICLE MAVLink v1 frames (datafile.bin),
+    # AdsbStore rows (adsb_store.bin), callsigns and ICAO addresses.
+    # Typical values only, deflate takes matches from it, not exact records.
+    parts = []
+    calls = (b'ELY', b'ISR', b'AIZ', b'UAL', b'DLH', b'BAW', b'RYR', b'THY', b'WZZ', b'AFR')
+    for i, call in enumerate(calls):
+        callsign = call + b'%03d ' % (100 + 37 * i)
+        icao = 0x738000 + 0x41 * i
+        lat, lon = 320000000 + 1234567 * i, 348000000 + 765432 * i
+        alt = 10668000 - 304800 * i
+        # AdsbStore row, see ADSB_DTYPE
+        parts.append(struct.pack('<IiiiHHhH8sHH', icao, lat, lon, alt, 9000 + 500 * i, 22000 + 300 * i, 0,
+                                 1200 + i, callsign[:8], 1 + i, 30 * i))
+        # ADSB_VEHICLE payload in wire order, after the v1 header fe 26 seq sys comp f6
+        payload = struct.pack('<IiiiHHhHHB9sBB', icao, lat, lon, alt, 9000 + 500 * i, 22000 + 300 * i, 0,
+                              0x01ff, 1200 + i, 1, callsign + b'\x00', 3, 1)
+        parts.append(bytes([0xfe, 0x26, i, 0x01, 0x9c, 0xf6]) + payload + b'\x00\x00')
+    parts.append(b''.join(c + b'%03d' % (100 + i) + b'\x00' * 5 for i, c in enumerate(calls)))
+    parts.append(b''.join(struct.pack('<I', 0x738000 + 0x41 * i) for i in range(len(calls))))
+    return b''.join(parts)
+
+
+def textDict():
+    # uploaded script results, tracebacks and the text outputs, the most
+    # common strings last (deflate reaches them with the shortest distance)
+    return (b'SyntaxError: invalid syntax\nNameError: name  is not defined\nTypeError: '
+            b'ValueError: ZeroDivisionError: division by zero\nIndexError: list index out of range\n'
+            b'KeyError: AttributeError: object has no attribute \nModuleNotFoundError: No module named '
+            b'Traceback (most recent call last):\n  File "", line , in main\n    '
+            b'def main():\n    return \nif __name__ == "__main__":\n    main()\n#Execute script'
+            b'0123456789 0.0, 1.0, [], {}, (), None, True, False, ')
+
+
+DICTS = {DICT_NONE: b'', DICT_ADSB: adsbDict(), DICT_TEXT: textDict()}
+
+
+def deflate(data, zdict):
+    if zdict:
+        c = zlib.compressobj(LEVEL, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        c = zlib.compressobj(LEVEL, zlib.DEFLATED, -15, 9)
+    return c.compress(data) + c.flush()
+
+
+def eligible(file_type, data, name=''):
+    if file_type not in COMPRESS_TYPES or len(data) < MIN_SIZE or name.lower().endswith(IMAGE_EXT):
+        return False
+    head = bytes(data[:8])
+    return not any(head.startswith(magic) for magic in MAGIC)
+
+
+def compress(file_type, data, name=''):
+    # returns (file type | COMPRESSED, compressed data) when it is smaller,
+    # (file type, data) as given otherwise. name: of the file data is from
+    if not eligible(file_type, data, name):
+        return file_type, data
+    best = None
+    for dict_id, zdict in DICTS.items():
+        packed = deflate(data, zdict)
+        if best is None or len(packed) < len(best[1]):
+            best = dict_id, packed
+    dict_id, packed = best
+    if 1 + len(packed) >= len(data):
+        return file_type, data
+    return file_type | COMPRESSED, bytes([dict_id]) + packed
+
+
+def decompress(file_type, data):
+    # ground side: returns (file type, data) as they were before compress()
+    if not file_type & COMPRESSED:
+        return file_type, data
+    zdict = DICTS[data[0]]
+    d = zlib.decompressobj(-15, zdict) if zdict else zlib.decompressobj(-15)
+    return file_type & ~COMPRESSED, d.decompress(data[1:]) + d.flush()
+
+
+if __name__ == "__main__":
+    # bytes saved per DataTypes class on the files a mission leaves in the
+    # outbox: an ADS-B replay (datafile, store, callsigns, tracks, telemetry),
+    # command stats, text, and images. More files or folders can be given.
+    import os
+    import sys
+    import time
+    import shutil
+    import tempfile
+
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ADSB'))
+    from msgGenerator import MsgGenerator, LEGACY_MAX, CHUNK_SIZE
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    root = os.path.dirname(os.path.dirname(here))
+    work = tempfile.mkdtemp(prefix='codec_bench_')
+    paths = []
+    try:
+        from adsb_replay import synth_stream, replay
+        stream, expected = synth_stream(2000, 40)
+        out = os.path.join(work, 'adsb')
+        replay(stream, expected, out_fld=out)
+        paths += [os.path.join(out, name) for name in sorted(os.listdir(out)) if not name.startswith('.')]
+    except Exception as e:
+        print(f'no ADS-B replay: {e}')
+    import cmdStats
+    stats = cmdStats.CommandStats(3)
+    for cmd in (1, 1, 2, 2, 2, 15):
+        stats.begin(cmd)
+        stats.end()
+    stats.addPhase(7, 'service', 2.5)
+    paths.append(stats.save(work, 7))
+    with open(os.path.join(work, '_metafile.bin'), 'wb') as f:
+        f.write(struct.pack('<HBB', 14321, 7, 1))
+    with open(os.path.join(work, 'metastars.bin'), 'wb') as f:
+        f.write(bytes([30]) + b''.join(struct.pack('<HH', 37 * i % 1280, 91 * i % 720) for i in range(30)))
+    # uploaded script result, laid out as uploading.writeMetaFile does
+    result = str({'cpu_temp': 41.2, 'load': [0.35, 0.41, 0.38], 'outbox': ['7', '8', '9'], 'free_mb': 812})
+    with open(os.path.join(work, '_metaUploadingFile.bin'), 'wb') as f:
+        f.write(bytes([1, 3, len(result) & 0xff]) + result.encode())
+    paths += [os.path.join(work, '_metafile.bin'), os.path.join(work, 'metastars.bin'),
+              os.path.join(work, '_metaUploadingFile.bin')]
+    paths += [os.path.join(root, 'MD', name) for name in ('RPI_Commands.md', 'Commands.md')]
+    paths += [os.path.join(root, 'photos', name) for name in sorted(os.listdir(os.path.join(root, 'photos')))]
+    for arg in sys.argv[1:]:
+        if os.path.isdir(arg):
+            paths += [os.path.join(arg, name) for name in sorted(os.listdir(arg))]
+        else:
+            paths.append(arg)
+
+    fileType = MsgGenerator.fileType
+    rows = {}
+    for path in paths:
+        name = os.path.basename(path)
+        file_type = fileType(None, name)
+        # the samples from the repo, as they would be typed in the outbox
+        if name.endswith('.md'):
+            file_type = DataTypes.TEXT.value
+        elif name.endswith(('.jpg', '.jpeg')):
+            file_type = DataTypes.IMG_JPG.value
+        with open(path, 'rb') as f:
+            data = f.read()
+        # as it goes down: whole below LEGACY_MAX, chunks above
+        step = len(data) if len(data) < LEGACY_MAX else CHUNK_SIZE
+        sent = 0
+        start = time.perf_counter()
+        for offset in range(0, max(len(data), 1), max(step, 1)):
+            chunk = data[offset:offset + step]
+            packed_type, packed = compress(file_type, chunk, name)
+            assert decompress(packed_type, packed) == (file_type, chunk)
+            sent += len(packed)
+        secs = time.perf_counter() - start
+        try:
+            cls = DataTypes(file_type).name
+        except ValueError:
+            cls = f'type {file_type}'
+        row = rows.setdefault(cls, [0, 0, 0, 0.0])
+        row[0] += 1
+        row[1] += len(data)
+        row[2] += sent
+        row[3] += secs
+        print(f'{cls:>10} {name:<28} {len(data):>8} -> {sent:>8} bytes')
+    print()
+    print(f'{"class":>10} {"files":>6} {"bytes":>9} {"sent":>9} {"saved":>7} {"ms":>8}')
+    for cls, (files, raw, sent, secs) in sorted(rows.items()):
+        saved = 100 * (raw - sent) / raw if raw else 0
+        print(f'{cls:>10} {files:>6} {raw:>9} {sent:>9} {saved:>6.1f}% {secs * 1000:>8.2f}')
+    shutil.rmtree(work)
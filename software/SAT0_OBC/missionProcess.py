@@ -0,0 +1,239 @@
+'''
+    @file missionProcess.py
+    @brief Long-lived process that runs the image missions for SATLLA0 OBC.
+
+    Copyright (C) 2023 @author Aharon Gorodischer
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+import time
+import importlib
+import threading
+import traceback
+import multiprocessing
+
+import prewarm
+
+# imported and warmed before the first mission, set with [missionProcess] modules
+MODULES = ('numpy', 'PIL.Image', 'cv2', 'TakePicSmart', 'SatImageTaking.start_service')
+
+# task name: (module, function), the only calls the process takes
+TASKS = {
+    'take_pic_smart': ('TakePicSmart', 'take_pic_smart'),
+    'start_service': ('SatImageTaking.start_service', 'main'),
+    # does nothing, to check the process answers
+    'ping': ('os', 'getpid'),
+}
+
+# restarted after a mission that leaves it bigger than this
+MAX_RSS = 256 * 1024 * 1024
+# killed and restarted if a mission takes longer
+TIMEOUT = 600
+
+
+def rss():
+    # resident bytes of this process now, peak if /proc is not there
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def serve(conn, modules):
+    # the mission process: warm up, then run one request at a time
+    # request: (mission, task, args), reply: (mission, error or None, secs, rss)
+    times = {}
+    for name in modules:
+        start = time.perf_counter()
+        try:
+            prewarm.warm(name, importlib.import_module(name))
+            times[name] = time.perf_counter() - start
+        except Exception as e:
+            print(f'MissionProcess {name}: {e}')
+            times[name] = None
+    conn.send(('ready', times))
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if request is None:
+            break
+        mission, task, args = request
+        start = time.perf_counter()
+        error = None
+        try:
+            module, func = TASKS[task]
+            getattr(importlib.import_module(module), func)(*args)
+        except Exception:
+            error = traceback.format_exc()
+        conn.send((mission, error, time.perf_counter() - start, rss()))
+    conn.close()
+
+
+# Runs TASKS in a child process that keeps cv2, numpy and PIL imported
+# between missions, so a mission does not pay for the imports and a crash
+# in native code takes down the child, not the controller. The child is
+# forked from a forkserver that preloads the modules, which makes a restart
+# after a crash, a timeout or memory growth cheap. The first start waits
+# for those imports, startLater() runs it on a thread so boot does not.
+# call() blocks, it is made from the MissionWorker thread only.
+class MissionProcess(object):
+    def __init__(self, modules=MODULES, maxRss=MAX_RSS, timeout=TIMEOUT, stats=None):
+        self.modules = tuple(modules)
+        self.maxRss = maxRss
+        self.timeout = timeout
+        self.stats = stats
+        self.process = None
+        self.conn = None
+        self.restarts = 0
+        # the thread of startLater(), until call() or stop() joins it
+        self.starting = None
+        # name: secs of the last warm-up, None if the import failed
+        self.times = {}
+        try:
+            self.ctx = multiprocessing.get_context('forkserver')
+            # __main__ too, or every child imports Main.py and the controller again
+            self.ctx.set_forkserver_preload(['__main__'] + list(self.modules) + ['prewarm'])
+        except ValueError:
+            # no forkserver on this platform
+            self.ctx = multiprocessing.get_context('spawn')
+
+    def start(self):
+        parent, child = self.ctx.Pipe()
+        self.process = self.ctx.Process(target=serve, args=(child, self.modules),
+                                        name='MissionProcess', daemon=True)
+        self.process.start()
+        child.close()
+        self.conn = parent
+        print(f'MissionProcess started. pid: {self.process.pid}')
+        return self
+
+    def startLater(self):
+        self.starting = threading.Thread(target=self.start, name='MissionProcessStart', daemon=True)
+        self.starting.start()
+        return self
+
+    def started(self):
+        if self.starting is not None:
+            self.starting.join()
+            self.starting = None
+
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def stop(self, timeout=5):
+        self.started()
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+        print(f'MissionProcess stopped. exitcode: {self.process.exitcode}')
+        self.process = None
+
+    def restart(self, reason):
+        print(f'MissionProcess restart: {reason}')
+        self.restarts += 1
+        self.stop()
+        self.start()
+
+    def call(self, mission, task, *args):
+        # runs task(*args) in the process, returns True if it did not fail
+        self.started()
+        if not self.alive():
+            if self.process is not None:
+                self.restart(f'exitcode {self.process.exitcode}')
+            else:
+                self.start()
+        try:
+            self.conn.send((mission, task, args))
+        except (OSError, ValueError) as e:
+            self.restart(e)
+            self.conn.send((mission, task, args))
+        deadline = time.monotonic() + self.timeout
+        while True:
+            left = deadline - time.monotonic()
+            try:
+                if left <= 0 or not self.conn.poll(left):
+                    self.restart(f'mission {mission} timed out after {self.timeout} secs')
+                    return False
+                reply = self.conn.recv()
+            except (EOFError, OSError):
+                # died in the middle of the mission
+                self.process.join(1)
+                self.restart(f'died in mission {mission}, exitcode {self.process.exitcode}')
+                return False
+            if reply[0] == 'ready':
+                self.times = reply[1]
+                if self.stats is not None:
+                    for name, secs in self.times.items():
+                        if secs is not None:
+                            self.stats.addPhase(mission, f'process {name}', secs)
+                continue
+            break
+        mission, error, secs, size = reply
+        print(f'MissionProcess mission {mission}: {secs:.3f} secs, rss {size // 1024} KB')
+        if error is not None:
+            print(error)
+        if size > self.maxRss:
+            self.restart(f'rss {size // 1024} KB')
+        return error is None
+
+
+if __name__ == "__main__":
+    # mission turnaround: the imports a mission pays in a fresh process,
+    # against a call to the warm process, with a task that does no work
+    import subprocess
+
+    modules = tuple(sys.argv[1:]) or ('numpy', 'TakePicSmart')
+    code = (f'import time, importlib, prewarm; t = time.perf_counter()\n'
+            f'for m in {modules!r}: prewarm.warm(m, importlib.import_module(m))\n'
+            f'print(time.perf_counter() - t)')
+    runs = []
+    for _ in range(3):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], capture_output=True,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+        runs.append(time.perf_counter() - start)
+    print(f'fresh process + imports: {min(runs) * 1000:.1f} ms')
+
+    proc = MissionProcess(modules)
+    start = time.perf_counter()
+    proc.start()
+    proc.call(0, 'ping')
+    print(f'first call, process start included: {(time.perf_counter() - start) * 1000:.1f} ms')
+    runs = []
+    for mission in range(1, 21):
+        start = time.perf_counter()
+        proc.call(mission, 'ping')
+        runs.append(time.perf_counter() - start)
+    print(f'warm call: {sum(runs) / len(runs) * 1000:.2f} ms mean')
+
+    os.kill(proc.process.pid, 9)
+    start = time.perf_counter()
+    ok = proc.call(21, 'ping')
+    print(f'call after a crash: {(time.perf_counter() - start) * 1000:.1f} ms, restarts {proc.restarts}, ok {ok}')
+    proc.stop()
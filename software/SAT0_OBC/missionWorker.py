@@ -0,0 +1,78 @@
+'''
+    @file missionWorker.py
+    @brief Background mission runner for SATLLA0 OBC.
+
+    Copyright (C) 2023 @author Aharon Gorodischer
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import sys
+import queue
+import threading
+
+
+# Runs missions one at a time on its own thread so the serial thread
+# keeps answering CMD_GET_STATE and CMD_GET_DATA while a mission runs.
+class MissionWorker(object):
+    def __init__(self, maxsize=4, done=None):
+        self.queue = queue.Queue(maxsize)
+        # done(mission) is called when a mission ends, failed or not
+        self.done = done
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, mission, func, *args):
+        # returns False if the queue is full
+        try:
+            self.queue.put_nowait((mission, func, args))
+        except queue.Full:
+            print(f'MissionWorker queue full, mission {mission} dropped')
+            return False
+        print(f'Mission {mission} queued. Queue: {self.queue.qsize()}')
+        return True
+
+    def full(self):
+        return self.queue.full()
+
+    def busy(self):
+        # a mission is queued or running, its files are not in the outbox yet
+        return self.queue.unfinished_tasks > 0
+
+    def run(self):
+        print(f'MissionWorker thread started')
+        while True:
+            mission, func, args = self.queue.get()
+            if func is None:
+                break
+            print(f'Mission {mission} started')
+            try:
+                func(*args)
+            except:
+                exception_type, exception_object, exception_traceback = sys.exc_info()
+                from traceback import format_tb
+                error = format_tb(exception_traceback)[-1]
+                print()
+                print(exception_type, exception_object, error)
+            finally:
+                if self.done is not None:
+                    self.done(mission)
+                self.queue.task_done()
+            print(f'Mission {mission} finished')
+        print("MissionWorker completed")
+
+    def stop(self, timeout=None):
+        # let the queued missions finish, then end the thread
+        self.queue.put((None, None, ()))
+        self.thread.join(timeout)
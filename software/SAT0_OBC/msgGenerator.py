@@ -27,68 +27,173 @@
 import os
 import stat
 from define import *
+from outboxIndex import OutboxIndex, TX_PREFIX
+import downlinkCodec
+
+# the Teensy UART buffer is 2^14, a whole-file response must stay below it
+LEGACY_MAX = 16384
+CHUNK_SIZE = 8192
+# whole-file response header: mission (2), file type (1)
+HEADER_LEN = 3
+# chunked response header: mission (2), file type (1), file id (2), offset (4), total length (4)
+CHUNK_HEADER_LEN = 13
+# a file being sent in chunks is renamed .tx_<file id>_<name> (TX_PREFIX)
+# until the next file is asked for
 
 class MsgGenerator:
+    # file ids of chunked transfers, the controller keeps it in counters.bin (counterStore)
+    fileCount = 0
+    # chunked transfer in progress: [file id, mission, path, file type, next offset, total]
+    current = None
+    # compress the eligible payloads, see downlinkCodec
+    compress = False
+
+    def __init__(self):
+        self.outbox = OutboxIndex(self.fileType, 'outbox', LEGACY_MAX)
+        # responses are built here: file data is read in after room for the
+        # header, which frame() fills in. The view stays valid until the next read.
+        self.txBuf = bytearray(CHUNK_HEADER_LEN + LEGACY_MAX)
+        self.txView = memoryview(self.txBuf)
+
     def generateEmptySignal(self):
         result = bytearray([9])
         return result
 
-    # read the parts
+    def fileType(self, name, i=0):
+        if 'metafile' in name:
+            file_type = DataTypes.META.value
+        elif 'stars' in name:
+            file_type = DataTypes.STARS.value
+        elif 'pic' in name:
+            file_type = DataTypes.PHOTO.value
+        elif "full" in name:
+            file_type = DataTypes.FULL_PHOTO.value
+        elif "icon" in name:
+            file_type = DataTypes.ICON.value
+        elif "Img.jpeg" in name:
+            file_type = DataTypes.IMG_JPG.value
+        elif 'lap_pyr' in name:
+            try:
+                filename, file_extension = os.path.splitext(name)
+                lap_pyr = filename.split('_')[-1]
+                file_type = int(lap_pyr)
+            except:
+                file_type = i
+        else:
+            file_type = DataTypes.OTHER.value
+        return file_type
+
+    # read the parts. Files of LEGACY_MAX bytes or more are left for readChunk.
+    # Returns the data as a view into txBuf, see frame().
     def readMsg(self):
         print(f'readMsg()')
-        folderName = 'outbox'
         ans = b''
         mission = 0
         file_type = DataTypes.OTHER.value
 
-        # r=root, d=directories, f = files
-        if len(os.listdir(folderName)) < 1:
-            print("Directory is empty")
-            return mission, file_type, ans
-        print(f'Folders: {len(os.listdir(folderName))}')
-
-        for r, d, f in os.walk(folderName):
-            # if no files, continue
-            if len(f) < 1:
-                continue
-            mission = self.extractMission(r)
-            moveFolder = self.createMoveFolder(mission)
-
-            # loop file by file and send it
-            for i, name in enumerate(sorted(f)):
-                print(f'File Name: {name}')
-                if len(name) > 0 and not name.startswith('.'):
-                    if 'metafile' in name:
-                        file_type = DataTypes.META.value
-                    elif 'stars' in name:
-                        file_type = DataTypes.STARS.value
-                    elif 'pic' in name:
-                        file_type = DataTypes.PHOTO.value
-                    elif "full" in name:
-                        file_type = DataTypes.FULL_PHOTO.value
-                    elif "icon" in name:
-                        file_type = DataTypes.ICON.value
-                    elif "Img.jpeg" in name:
-                        file_type = DataTypes.IMG_JPG.value
-                    elif 'lap_pyr' in name:
-                        try:
-                            filename, file_extension = os.path.splitext(name)
-                            lap_pyr = filename.split('_')[-1]
-                            file_type = int(lap_pyr)
-                        except:
-                            file_type = i
-                    else:
-                        file_type = DataTypes.OTHER.value
-                    line = open(os.path.join(r, name), "rb").read()
-                    print(f'File Size: {len(line)}')
-                    # print(f'Line: {line}')
-                    # os.remove(os.path.join(r, name))
-                    os.rename(os.path.join(r, name),
-                              os.path.join(moveFolder, name))
-                    return mission, file_type, line
-
-        # reach end. no more files.
-        return mission, file_type, ans
+        while True:
+            entry = self.outbox.next()
+            if entry is None:
+                print("Directory is empty")
+                return mission, file_type, ans
+            mission, path, file_type = entry
+            print(f'File Name: {path}')
+            with open(path, "rb") as f:
+                size = f.readinto(self.txView[HEADER_LEN:HEADER_LEN + LEGACY_MAX])
+            print(f'File Size: {size}')
+            if size < LEGACY_MAX:
+                break
+            # grew since it was indexed, left in the outbox for readChunk
+            self.outbox.addBig(mission, path, file_type)
+        moveFolder = self.createMoveFolder(mission)
+        os.rename(path, os.path.join(moveFolder, os.path.basename(path)))
+        file_type, size = self.pack(file_type, HEADER_LEN, size, path)
+        return mission, file_type, self.txView[HEADER_LEN:HEADER_LEN + size]
+
+    def pack(self, file_type, start, size, name):
+        # compresses txBuf[start:start + size] in place when it pays,
+        # returns the file type (COMPRESSED flag set if so) and the new size
+        if not self.compress:
+            return file_type, size
+        packed_type, packed = downlinkCodec.compress(file_type, self.txView[start:start + size], name)
+        if packed_type != file_type:
+            print(f'Compressed: {size} -> {len(packed)}')
+            self.txBuf[start:start + len(packed)] = packed
+            size = len(packed)
+        return packed_type, size
+
+    def frame(self, header, size):
+        # header + the size bytes readMsg just read, without copying them
+        self.txBuf[:HEADER_LEN] = header
+        return self.txView[:HEADER_LEN + size]
+
+    # --------------------------
+    # chunked transfer. Returns the response (header and data) as a view
+    # into txBuf, None when there is nothing to send. file_id/offset resend a part of a file not finished yet,
+    # otherwise the next chunk of the current file or of the next file.
+    def readChunk(self, file_id=None, offset=None, size=CHUNK_SIZE):
+        print(f'readChunk(file_id={file_id}, offset={offset})')
+        if file_id is not None:
+            if self.current is None or self.current[0] != file_id:
+                if self.current is not None:
+                    # left unfinished, resumed later
+                    self.outbox.addTransfer(*self.current[:3])
+                self.current = self.openTransfer(self.outbox.popTransfer(file_id))
+            if self.current is None:
+                print(f'Unknown file id: {file_id}')
+                return None
+            self.current[4] = offset
+        elif self.current is not None and self.current[4] >= self.current[5]:
+            # the last chunk went out and the Teensy moved on
+            self.finishTransfer()
+
+        if self.current is None:
+            self.current = self.startTransfer()
+            if self.current is None:
+                return None
+
+        file_id, mission, path, file_type, offset, total = self.current
+        size = min(size, LEGACY_MAX)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            n = f.readinto(self.txView[CHUNK_HEADER_LEN:CHUNK_HEADER_LEN + size])
+        self.current[4] = offset + n
+        # offset and total count file bytes, a compressed chunk is n bytes once inflated
+        file_type, size = self.pack(file_type, CHUNK_HEADER_LEN, n, path)
+        self.txBuf[:CHUNK_HEADER_LEN] = mission.to_bytes(2, 'little') + file_type.to_bytes(1, 'little') + \
+            file_id.to_bytes(2, 'little') + offset.to_bytes(4, 'little') + total.to_bytes(4, 'little')
+        print(f'Chunk: file {file_id}, offset {offset}, size {n}, total {total}')
+        return self.txView[:CHUNK_HEADER_LEN + size]
+
+    def startTransfer(self):
+        # an interrupted transfer first, then the next outbox file
+        current = self.openTransfer(self.outbox.popTransfer())
+        if current is not None:
+            return current
+        entry = self.outbox.next(chunked=True)
+        if entry is None:
+            return None
+        mission, path, file_type = entry
+        file_id = self.fileCount
+        self.fileCount = (self.fileCount + 1) & 0xffff
+        root, name = os.path.split(path)
+        txPath = os.path.join(root, f'{TX_PREFIX}{file_id}_{name}')
+        os.rename(path, txPath)
+        return [file_id, mission, txPath, file_type, 0, os.path.getsize(txPath)]
+
+    def openTransfer(self, transfer):
+        # transfer: (file id, mission, path) from the outbox index
+        if transfer is None:
+            return None
+        file_id, mission, path = transfer
+        name = os.path.basename(path).split('_', 2)[-1]
+        return [file_id, mission, path, self.fileType(name), 0, os.path.getsize(path)]
+
+    def finishTransfer(self):
+        file_id, mission, path = self.current[:3]
+        name = os.path.basename(path)[len(f'{TX_PREFIX}{file_id}_'):]
+        os.rename(path, os.path.join(self.createMoveFolder(mission), name))
+        self.current = None
 
     def extractMission(self, root):
         try:
@@ -135,3 +240,6 @@ class MsgGenerator:
                     os.rmdir(root)
                 except OSError as e:
                     print("Error: %s - %s." % (e.filename, e.strerror))
+        if 'outbox' in folderName:
+            self.current = None
+            self.outbox.rebuild()
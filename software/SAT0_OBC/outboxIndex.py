@@ -0,0 +1,244 @@
+'''
+    @file outboxIndex.py
+    @brief In-memory index of the files waiting in the outbox for SATLLA0 OBC.
+
+    Copyright (C) 2023 @author Aharon Gorodischer
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import heapq
+import threading
+
+from define import DataTypes
+
+TX_PREFIX = '.tx_'
+
+# Downlink order by class, a DataTypes name or LAP_PYR for the pyramid
+# layers (their file type is the level, 1 = coarsest). Classes not listed
+# go last. Set with [downlink] priority in config.conf.
+PRIORITY = ('META', 'ICON', 'STARS', 'TEXT', 'LAP_PYR', 'IMG_JPG', 'PHOTO', 'DATA', 'OTHER', 'FULL_PHOTO')
+
+
+# The outbox is walked once at startup; after that a mission folder is
+# added when its mission ends, so GET_DATA takes the next file from a heap
+# instead of walking the tree. Files are sent by class priority, pyramid
+# layers coarse to fine, and round-robin across missions (oldest first)
+# within a class. Files of large bytes or more are kept in their own heap
+# since only chunked transfers can send them. A mission folder is held out
+# of the index from hold() until addMission(), so a rebuild meanwhile does
+# not take the partial files of a mission that is queued or running.
+class OutboxIndex(object):
+    def __init__(self, fileType, folderName='outbox', large=16384, priority=PRIORITY):
+        # fileType(name, i) -> DataTypes value
+        self.fileType = fileType
+        self.folderName = folderName
+        self.large = large
+        # rebuild() holds it while adding the folders
+        self.lock = threading.RLock()
+        self.built = False
+        # missions queued or running
+        self.held = set()
+        self.setPriority(priority)
+        self.clear()
+
+    def setPriority(self, priority):
+        self.rank = {name.strip().upper(): i for i, name in enumerate(priority)}
+        if self.built:
+            self.rebuild()
+
+    def clear(self):
+        # entries: (rank, turn, mission, seq, path, file type)
+        self.small = []
+        self.big = []
+        self.paths = set()
+        self.seq = 0
+        # files already queued per (mission, rank), gives the round-robin turn
+        self.rounds = {}
+        # interrupted chunked transfers: {file id: (mission, path)}
+        self.transfers = {}
+
+    def key(self, mission, name, file_type):
+        # (rank, turn) of a file
+        if 'lap_pyr' in name:
+            rank = self.rank.get('LAP_PYR', len(self.rank))
+            return rank, file_type
+        try:
+            cls = DataTypes(file_type).name
+        except ValueError:
+            cls = DataTypes.OTHER.name
+        rank = self.rank.get(cls, len(self.rank))
+        n = self.rounds.get((mission, rank), 0)
+        self.rounds[(mission, rank)] = n + 1
+        return rank, n
+
+    def __len__(self):
+        return len(self.small) + len(self.big)
+
+    def hasData(self):
+        with self.lock:
+            return len(self) > 0 or bool(self.transfers)
+
+    def rebuild(self):
+        # next() waits meanwhile, it never sees a half built index
+        with self.lock:
+            self.clear()
+            self.built = True
+            if not os.path.isdir(self.folderName):
+                return
+            self.addFolder(self.folderName, 0)
+            missions = []
+            for name in os.listdir(self.folderName):
+                if os.path.isdir(os.path.join(self.folderName, name)):
+                    try:
+                        missions.append(int(name))
+                    except ValueError:
+                        pass
+            for mission in sorted(missions):
+                if mission not in self.held:
+                    self.addFolder(os.path.join(self.folderName, str(mission)), mission)
+            print(f'Outbox index: {len(self)} files, {len(self.transfers)} transfers, {len(self.held)} held')
+
+    def hold(self, mission):
+        # the mission is queued, its folder is left out until addMission()
+        with self.lock:
+            self.held.add(mission)
+
+    def addMission(self, mission):
+        with self.lock:
+            self.held.discard(mission)
+            self.addFolder(os.path.join(self.folderName, str(mission)), mission)
+
+    def addFolder(self, root, mission):
+        try:
+            names = sorted(e.name for e in os.scandir(root) if e.is_file())
+        except OSError as e:
+            print(e)
+            return
+        with self.lock:
+            for i, name in enumerate(names):
+                path = os.path.join(root, name)
+                if name.startswith(TX_PREFIX):
+                    try:
+                        file_id = int(name[len(TX_PREFIX):].split('_', 1)[0])
+                        self.transfers[file_id] = (mission, path)
+                    except ValueError:
+                        pass
+                    continue
+                if not name or name.startswith('.') or path in self.paths:
+                    continue
+                file_type = self.fileType(name, i)
+                rank, turn = self.key(mission, name, file_type)
+                entry = (rank, turn, mission, self.seq, path, file_type)
+                self.seq += 1
+                self.paths.add(path)
+                heapq.heappush(self.big if os.path.getsize(path) >= self.large else self.small, entry)
+
+    def next(self, chunked=False):
+        # pops (mission, path, file type) of the most wanted file still there,
+        # chunked=False only returns files below large
+        if not self.built:
+            self.rebuild()
+        with self.lock:
+            while True:
+                if chunked and self.big and (not self.small or self.big[0] < self.small[0]):
+                    entry = heapq.heappop(self.big)
+                elif self.small:
+                    entry = heapq.heappop(self.small)
+                else:
+                    return None
+                rank, turn, mission, seq, path, file_type = entry
+                self.paths.discard(path)
+                if os.path.isfile(path):
+                    return mission, path, file_type
+
+    def addBig(self, mission, path, file_type):
+        # a file next() returned as small that has grown since, for chunks only
+        with self.lock:
+            rank, turn = self.key(mission, os.path.basename(path), file_type)
+            heapq.heappush(self.big, (rank, turn, mission, self.seq, path, file_type))
+            self.seq += 1
+            self.paths.add(path)
+
+    def addTransfer(self, file_id, mission, path):
+        with self.lock:
+            self.transfers[file_id] = (mission, path)
+
+    def popTransfer(self, file_id=None):
+        # file_id=None: the oldest interrupted transfer, if any
+        with self.lock:
+            if file_id is None:
+                if not self.transfers:
+                    return None
+                file_id = min(self.transfers)
+            item = self.transfers.pop(file_id, None)
+        if item is None or not os.path.isfile(item[1]):
+            return None
+        return (file_id,) + item
+
+
+if __name__ == "__main__":
+    # per GET_DATA cost with a growing backlog: os.walk per request as
+    # readMsg did before, against the index
+    import sys
+    import time
+    import shutil
+    import tempfile
+
+    def walk_next(folderName='outbox'):
+        if len(os.listdir(folderName)) < 1:
+            return None
+        len(os.listdir(folderName))
+        for r, d, f in os.walk(folderName):
+            if len(f) < 1:
+                continue
+            for i, name in enumerate(sorted(f)):
+                if len(name) > 0 and not name.startswith('.'):
+                    'metafile' in name or 'stars' in name or 'pic' in name
+                    return os.path.join(r, name)
+        return None
+
+    fileType = lambda name, i: 0
+    per_mission = 20
+    base = tempfile.mkdtemp(prefix='outbox_bench_')
+    cwd = os.getcwd()
+    os.chdir(base)
+    try:
+        print(f'{"files":>6} {"walk ms/req":>12} {"index ms/req":>13} {"rebuild ms":>11}')
+        for files in [int(a) for a in sys.argv[1:]] or [100, 1000, 5000]:
+            shutil.rmtree('outbox', ignore_errors=True)
+            for n in range(files):
+                fld = os.path.join('outbox', str(n // per_mission))
+                os.makedirs(fld, exist_ok=True)
+                with open(os.path.join(fld, f'pic_{n % per_mission:03d}.jpg'), 'wb') as f:
+                    f.write(b'x' * 64)
+            # each request removes the file it returns, as readMsg moves it to sent/
+            requests = min(200, files // 2)
+            start = time.perf_counter()
+            for _ in range(requests):
+                os.rename(walk_next(), 'sent.tmp')
+            walk = (time.perf_counter() - start) * 1000 / requests
+            start = time.perf_counter()
+            index = OutboxIndex(fileType)
+            index.rebuild()
+            rebuild = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            for _ in range(requests):
+                os.rename(index.next()[1], 'sent.tmp')
+            indexed = (time.perf_counter() - start) * 1000 / requests
+            print(f'{files:>6} {walk:>12.3f} {indexed:>13.3f} {rebuild:>11.1f}')
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(base)
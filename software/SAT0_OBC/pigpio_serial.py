@@ -17,20 +17,49 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
+import time
+import queue
+import threading
 import pigpio
+from concurrent.futures import Future
+
+BITS_PER_BYTE = 10 # start + 8 data + stop
+POLL_BYTES = 64 # bytes expected between two polls when data is flowing
+POLL_MAX = 0.1 # secs, longest back-off when the line is quiet
+PIGPIO_READ_MAX = 10000 # bb_serial_read returns at most this many bytes
+WAVE_CHUNK = 128 # bytes per wave, up to 10 pulses each
+CHAIN_WAVES = 4 # waves per wave_chain, keeps well under the DMA control block limit
+TX_QUEUE = 32 # payloads waiting for the writer thread
 
 class PigpioCom(object):
     listener_run = True
     tx_pin = 20
     rx_pin = 21
     baudrate = 9600
+    timeout = 0.75
 
     # thread = None
 
-    def __init__(self, tx_pin = 20, rx_pin = 21, baudrate = 9600):
+    def __init__(self, tx_pin = 20, rx_pin = 21, baudrate = 9600, timeout = 0.75, max_buffer = 65536):
         self.tx_pin = tx_pin
         self.rx_pin = rx_pin
         self.baudrate = baudrate
+        self.timeout = timeout
+        self.max_buffer = max_buffer
+        # bytes read from pigpio but not yet returned to the caller
+        self.rx = bytearray()
+        # poll period: time to receive POLL_BYTES, doubled while the line is quiet
+        self.poll_min = POLL_BYTES * BITS_PER_BYTE / self.baudrate
+        self.poll_max = max(POLL_MAX, self.poll_min)
+        self.poll = self.poll_min
+        # accounting
+        self.bytes_in = 0
+        self.overflow = 0 # bytes dropped because rx was full
+        self.saturated = 0 # reads that came back full, pigpiod may have lost data
+        self.bytes_out = 0
+        # writes are queued as (data, future) and sent by the writer thread
+        self.tx_queue = queue.Queue(TX_QUEUE)
+        self.writer = None
         self.serialpi = pigpio.pi()
         self.serialpi.set_mode(self.rx_pin, pigpio.INPUT)
         self.serialpi.set_mode(self.tx_pin, pigpio.OUTPUT)
@@ -42,27 +71,123 @@ class PigpioCom(object):
         self.serialpi.bb_serial_read_close(self.rx_pin)
         pigpio.exceptions = True
         self.serialpi.bb_serial_read_open(self.rx_pin, self.baudrate, 8)
+        self.rx = bytearray()
+
+    @property
+    def in_waiting(self):
+        self._fill()
+        return len(self.rx)
 
-    def read(self, bytes = 1000):
+    def _fill(self):
         count, data = self.serialpi.bb_serial_read(self.rx_pin)
-        if count > bytes:
-            # print(f'read(): {count}, {data}')
-            return data[:bytes]
-        if count > 0:
-            # print(f'read(): {count}, {data}')
-            return data
-        return b''
+        if count <= 0:
+            return 0
+        self.bytes_in += count
+        if count >= PIGPIO_READ_MAX:
+            self.saturated += 1
+        room = self.max_buffer - len(self.rx)
+        if count > room:
+            self.overflow += count - room
+            data = data[:room]
+        self.rx += data
+        return count
+
+    def _wait(self, got, deadline):
+        # back off while nothing arrives, poll at the byte rate while it does
+        self.poll = self.poll_min if got else min(self.poll * 2, self.poll_max)
+        left = deadline - time.monotonic()
+        if left > 0:
+            time.sleep(min(self.poll, left))
+        return left > 0
+
+    def _take(self, n):
+        data = bytes(self.rx[:n])
+        del self.rx[:n]
+        return data
+
+    def read(self, bytes = 1000, timeout = None):
+        # block until bytes are buffered or timeout secs passed, like serial.Serial.read
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            got = self._fill()
+            if len(self.rx) >= bytes or not self._wait(got, deadline):
+                return self._take(bytes)
+
+    def read_until(self, expected = b'\n', size = None, timeout = None):
+        # return up to and including expected, size bytes, or what came before timeout
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        start = 0
+        while True:
+            got = self._fill()
+            idx = self.rx.find(expected, start)
+            if idx >= 0:
+                n = idx + len(expected)
+                return self._take(n if size is None else min(n, size))
+            if size is not None and len(self.rx) >= size:
+                return self._take(size)
+            start = max(0, len(self.rx) - len(expected) + 1)
+            if not self._wait(got, deadline):
+                return self._take(len(self.rx) if size is None else size)
 
     def readline(self, bytes=1000):
-        return self.read(bytes)
+        return self.read_until(b'\n', bytes)
 
     def write(self, data):
-        self.serialpi.wave_clear()
-        self.serialpi.wave_add_serial(self.tx_pin, self.baudrate, data)
-        wid=self.serialpi.wave_create()
-        self.serialpi.wave_send_once(wid)
-        while self.serialpi.wave_tx_busy():
-            pass
-        self.serialpi.wave_delete(wid)
-        # print(f'write(): {len(data)}, {data}')
+        # queue data for the writer thread and return at once
+        self.write_async(data)
         return len(data)
+
+    def write_async(self, data):
+        # returns a Future that completes with len(data) once it left the pin
+        future = Future()
+        if self.writer is None or not self.writer.is_alive():
+            self.serialpi.wave_clear()
+            self.writer = threading.Thread(target=self._writer, daemon=True)
+            self.writer.start()
+        self.tx_queue.put((bytes(data), future))
+        return future
+
+    def flush(self, timeout = None):
+        # wait until everything queued so far has been sent
+        self.write_async(b'').result(timeout)
+
+    def close(self):
+        if self.writer is not None and self.writer.is_alive():
+            self.tx_queue.put((None, None))
+            self.writer.join()
+        self.writer = None
+        pigpio.exceptions = False
+        self.serialpi.bb_serial_read_close(self.rx_pin)
+        pigpio.exceptions = True
+
+    def _writer(self):
+        while True:
+            data, future = self.tx_queue.get()
+            if data is None:
+                break
+            try:
+                for i in range(0, len(data), WAVE_CHUNK * CHAIN_WAVES):
+                    self._send_chain(data[i:i + WAVE_CHUNK * CHAIN_WAVES])
+                self.bytes_out += len(data)
+                future.set_result(len(data))
+            except Exception as e:
+                print(f'Error in _writer(): {e}')
+                future.set_exception(e)
+
+    def _send_chain(self, data):
+        # one wave per chunk, sent back to back with wave_chain
+        wids = []
+        try:
+            for i in range(0, len(data), WAVE_CHUNK):
+                self.serialpi.wave_add_serial(self.tx_pin, self.baudrate, data[i:i + WAVE_CHUNK])
+                wids.append(self.serialpi.wave_create())
+            self.serialpi.wave_chain(wids)
+            # sleep for the air time, then poll briefly for the tail
+            time.sleep(len(data) * BITS_PER_BYTE / self.baudrate)
+            while self.serialpi.wave_tx_busy():
+                time.sleep(self.poll_min)
+        finally:
+            for wid in wids:
+                self.serialpi.wave_delete(wid)
@@ -0,0 +1,130 @@
+'''
+    @file prewarm.py
+    @brief Background import of the mission libraries for SATLLA0 OBC.
+
+    Copyright (C) 2023 @author Aharon Gorodischer
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+import time
+import threading
+import importlib
+
+# in the order a first mission needs them, set with [startup] prewarm
+PREWARM = ('numpy', 'PIL.Image', 'cv2', 'TakePicSmart', 'SatImageTaking.start_service', 'ADSB.adsb_listener')
+
+
+def warm(name, module):
+    # first calls that load plugins or allocate lazily
+    if name == 'numpy':
+        module.zeros((16, 16)).sum()
+    elif name == 'PIL.Image':
+        # registers every format plugin, JPEG 2000 included
+        module.init()
+    elif name == 'cv2':
+        import numpy as np
+        img = module.GaussianBlur(np.zeros((16, 16), np.uint8), (3, 3), 0)
+        module.imencode('.jpg', img)
+
+
+# Imports the modules one by one on a low priority thread once the serial
+# link is up. A mission that needs a module being imported waits on
+# Python's import lock for the rest of it, never imports it twice.
+class Prewarmer(object):
+    def __init__(self, modules=PREWARM, stats=None, delay=0, nice=10):
+        self.modules = modules
+        self.stats = stats
+        self.delay = delay
+        self.nice = nice
+        # name: secs, None if the import failed
+        self.times = {}
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.nice)
+        except (AttributeError, OSError) as e:
+            print(e)
+        time.sleep(self.delay)
+        for name in self.modules:
+            start = time.perf_counter()
+            try:
+                warm(name, importlib.import_module(name))
+            except Exception as e:
+                print(f'prewarm {name}: {e}')
+                self.times[name] = None
+                continue
+            secs = time.perf_counter() - start
+            self.times[name] = secs
+            if self.stats is not None:
+                self.stats.addPhase(0, f'prewarm {name}', secs)
+            print(f'prewarm {name}: {secs:.3f} secs')
+        self.done.set()
+
+
+if __name__ == "__main__":
+    # startup profile: what Main.py pays before the link answers, and
+    # what each prewarm module costs cold, each in a fresh interpreter
+    import shutil
+    import tempfile
+    import subprocess
+
+    # Controller() creates outbox/, sent/ and counters.bin in its cwd,
+    # so the profile runs in a scratch folder with a copy of config.conf
+    here = os.path.dirname(os.path.abspath(__file__))
+    scratch = tempfile.mkdtemp(prefix='obc_profile_')
+    shutil.copy(os.path.join(here, 'config.conf'), scratch)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([here, os.environ.get('PYTHONPATH', '')]))
+
+    def run_python(code, *flags):
+        start = time.perf_counter()
+        res = subprocess.run([sys.executable, *flags, '-c', code], capture_output=True, text=True,
+                             cwd=scratch, env=env)
+        return time.perf_counter() - start, res
+
+    secs, res = run_python('import controller', '-X', 'importtime')
+    rows = []
+    for line in res.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            own, total, name = line[len('import time:'):].split('|')
+            if own.strip().isdigit() and not name.startswith('  '):
+                rows.append((int(total), name.strip()))
+    print(f'import controller: {secs:.3f} secs (interpreter included)')
+    for total, name in sorted(rows, reverse=True)[:10]:
+        print(f'{total / 1e6:10.3f}  {name}')
+
+    secs, res = run_python('import time; t = time.perf_counter(); import controller; '
+                           'controller.Controller(); print(time.perf_counter() - t)')
+    ready = res.stdout.strip().splitlines()[-1] if res.returncode == 0 else res.stderr.strip().splitlines()[-1]
+    print(f'import + Controller() until the link answers: {ready}')
+
+    modules = sys.argv[1:] or PREWARM
+    print(f'cold import + warm-up per module:')
+    for name in modules:
+        secs, res = run_python(f'import time, prewarm, importlib; t = time.perf_counter(); '
+                               f'prewarm.warm({name!r}, importlib.import_module({name!r})); '
+                               f'print(time.perf_counter() - t)')
+        if res.returncode == 0:
+            print(f'{float(res.stdout.split()[-1]):10.3f}  {name}')
+        else:
+            print(f'{"failed":>10}  {name}: {res.stderr.strip().splitlines()[-1]}')
+    shutil.rmtree(scratch)
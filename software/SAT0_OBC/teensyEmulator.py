@@ -0,0 +1,353 @@
+'''
+    @file teensyEmulator.py
+    @brief Teensy stand-in over a pty, runs the OBC end to end for SATLLA0.
+
+    Copyright (C) 2023 @author Rony Ronen
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+import pty
+import time
+import shutil
+import select
+import signal
+import argparse
+import tempfile
+import subprocess
+import configparser
+
+from define import *
+import cmdFramer
+from downlinkCodec import COMPRESSED
+from msgGenerator import HEADER_LEN, CHUNK_HEADER_LEN
+
+OBC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# SAT0_Master/RPI_Integration.ino
+EOL = b'\n'
+TENTH_SEC = 0.1
+SEC_1 = 1.0
+SECS_3 = 3.0
+SECS_30 = 30.0
+LRG_BUFFER_SIZE_MAX = 16384
+GET_DATA_TRIES = 2
+# SAT0_Master.ino
+RPI_COMMAND_TRIES = 3
+# between two check_rpi_status() calls of the main loop, per pace
+LOOP_SECS = {'teensy': 1.0, 'fast': 0.05}
+
+
+# Plays the Teensy side of the RPI UART on a pty. pace='teensy' waits the
+# fixed delays of RPI_Integration.ino and reads what arrived meanwhile, as
+# the firmware does. pace='fast' reads until the reply is followed by gap
+# secs of silence, which measures the OBC rather than the firmware. Every
+# command records the time to the first byte of its reply. Payloads are
+# counted as the Teensy stores them, compressed ones are not decoded since
+# neither the Teensy nor the ground can.
+class TeensyEmulator(object):
+    def __init__(self, fd, pace='teensy', framing='legacy', chunked=False, gap=0.02, baud=115200):
+        self.fd = fd
+        self.pace = pace
+        self.framing = framing
+        self.chunked = chunked
+        self.gap = gap
+        self.baud = baud
+        self.seq = 0
+        # command: [reply latencies in secs]
+        self.latency = {}
+        self.files = 0
+        self.fileBytes = 0
+        self.wireBytes = 0
+        self.oversize = 0
+        # payloads with COMPRESSED on the type byte
+        self.undecodable = 0
+        # missions some file was received of, and chunked file ids
+        self.missions = set()
+        self.fileIds = set()
+
+    # --------------------------
+    # link
+    def flush(self):
+        # rpi_serial_flush()
+        while select.select([self.fd], [], [], 0)[0]:
+            if not os.read(self.fd, 65536):
+                break
+
+    def write(self, payload, pause=0.0):
+        # payload then EOL, or one frame with framing = crc
+        if self.framing == 'crc':
+            os.write(self.fd, cmdFramer.frame(payload, self.seq))
+            self.seq = (self.seq + 1) & 0xff
+            return
+        os.write(self.fd, bytes(payload))
+        if pause:
+            time.sleep(pause)
+        os.write(self.fd, EOL)
+
+    def read(self, wait, timeout=5.0):
+        # returns (reply, secs to its first byte or None)
+        start = time.perf_counter()
+        first = None
+        data = bytearray()
+        while True:
+            now = time.perf_counter()
+            if self.pace == 'teensy':
+                left = start + wait - now
+            elif first is None:
+                left = start + timeout - now
+            else:
+                left = self.gap
+            if left <= 0:
+                break
+            if not select.select([self.fd], [], [], left)[0]:
+                if self.pace != 'teensy':
+                    break
+                continue
+            chunk = os.read(self.fd, 65536)
+            if first is None:
+                first = time.perf_counter() - start
+            data += chunk
+        if self.pace != 'teensy' and self.baud and data:
+            # the pty is faster than the UART, wait out the wire time
+            wire = len(data) * 10 / self.baud - (time.perf_counter() - start)
+            if wire > 0:
+                time.sleep(wire)
+        return bytes(data), first
+
+    def command(self, payload, wait, pause=0.0):
+        self.write(payload, pause)
+        reply, first = self.read(wait)
+        if first is not None:
+            self.latency.setdefault(payload[0], []).append(first)
+        return reply
+
+    # --------------------------
+    # RPI_Integration.ino
+    def getState(self):
+        self.flush()
+        reply = self.command([CmdTypes.CMD_GET_STATE.value], SEC_1)
+        return reply[:1] == bytes([StateTypes.STATE_READY.value])
+
+    def mission(self, payload):
+        # rpi_mission(): True if the mission was answered
+        teensy = self.pace == 'teensy'
+        self.flush()
+        if teensy:
+            time.sleep(TENTH_SEC)
+        if not self.getState():
+            return False
+        if teensy:
+            time.sleep(TENTH_SEC)
+        reply = self.command(payload, SEC_1, TENTH_SEC if teensy else 0.0)
+        return reply[:1] == bytes([ApiTypes.API_ACK.value])
+
+    def checkStatus(self):
+        # check_rpi_status(): True once the RPI says there is no more data
+        if not self.getState():
+            return False
+        start = time.monotonic()
+        tries = 0
+        request = [CmdTypes.CMD_GET_DATA.value] + ([1] if self.chunked else [])
+        while time.monotonic() - start < SECS_30:
+            reply = self.command(request, SECS_3)
+            if not reply:
+                tries += 1
+                if tries > GET_DATA_TRIES:
+                    return True
+                continue
+            if len(reply) > LRG_BUFFER_SIZE_MAX:
+                self.oversize += 1
+                self.flush()
+                continue
+            if len(reply) == 1:
+                if reply[0] in (ApiTypes.API_NO_DATA.value, ApiTypes.API_NONE.value):
+                    return True
+                continue
+            self.received(reply)
+        return False
+
+    def received(self, reply):
+        self.wireBytes += len(reply)
+        self.missions.add(int.from_bytes(reply[0:2], 'little'))
+        if reply[2] & COMPRESSED:
+            self.undecodable += 1
+        if self.chunked:
+            self.fileIds.add(int.from_bytes(reply[3:5], 'little'))
+            self.files = len(self.fileIds)
+            self.fileBytes += len(reply) - CHUNK_HEADER_LEN
+        else:
+            self.fileBytes += len(reply) - HEADER_LEN
+            self.files += 1
+
+    def power(self, timeout=3600):
+        # the main loop: check_rpi_status() until the task is completed, when
+        # SAT0_Master sends POWER_OFF. Returns the secs it took.
+        start = time.monotonic()
+        while not self.checkStatus():
+            if time.monotonic() - start > timeout:
+                break
+            time.sleep(LOOP_SECS[self.pace])
+        return time.monotonic() - start
+
+
+# --------------------------
+# the OBC in a scratch folder
+def seedOutbox(folder, missions, first=100):
+    # text, metadata, ADS-B output and jpeg-like random data per mission,
+    # numbered from first. Returns the file count.
+    text = (b'Traceback (most recent call last):\n  File "script1.py", line 3, in main\n'
+            b'ZeroDivisionError: division by zero\n') * 20
+    adsb = os.path.join(folder, '.adsb')
+    try:
+        sys.path.append(os.path.join(OBC_DIR, 'ADSB'))
+        from adsb_replay import synth_stream, replay
+        stream, expected = synth_stream(2000, 40)
+        replay(stream, expected, out_fld=adsb)
+    except Exception as e:
+        print(f'no ADS-B replay: {e}')
+    for m in range(first, first + missions):
+        fld = os.path.join(folder, 'outbox', str(m))
+        os.makedirs(fld, exist_ok=True)
+        files = {'_metafile.bin': bytes([0x10, 0x27, m & 0xff, 1]),
+                 'output.txt': text,
+                 'Img.jpeg': b'\xff\xd8\xff' + os.urandom(6000 + 500 * (m % 8)),
+                 'icon.jpeg': b'\xff\xd8\xff' + os.urandom(900)}
+        if os.path.isdir(adsb):
+            for name in os.listdir(adsb):
+                if not name.startswith('.'):
+                    shutil.copy(os.path.join(adsb, name), fld)
+        for name, data in files.items():
+            with open(os.path.join(fld, name), 'wb') as f:
+                f.write(data)
+    shutil.rmtree(adsb, ignore_errors=True)
+    return sum(len(files) for _, _, files in os.walk(os.path.join(folder, 'outbox')))
+
+
+def startObc(folder, tty, framing, compress):
+    # Main.py as on the RPI, with its own config.conf and counters
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(os.path.join(OBC_DIR, 'config.conf'))
+    config.set('global', 'serialpath', tty)
+    config.set('global', 'framing', framing)
+    config.set('downlink', 'compress', '1' if compress else '0')
+    with open(os.path.join(folder, 'config.conf'), 'w') as f:
+        config.write(f)
+    log = open(os.path.join(folder, 'obc.log'), 'w')
+    env = dict(os.environ, PYTHONPATH=OBC_DIR, PYTHONUNBUFFERED='1')
+    return subprocess.Popen([sys.executable, os.path.join(OBC_DIR, 'Main.py')], cwd=folder,
+                            stdout=log, stderr=subprocess.STDOUT, env=env, start_new_session=True)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Drive the OBC over a pty like the Teensy does')
+    parser.add_argument('--pace', choices=('teensy', 'fast'), default='fast',
+                        help='teensy: the fixed delays of RPI_Integration.ino, fast: reply driven')
+    parser.add_argument('--framing', choices=('legacy', 'crc'), default='legacy')
+    parser.add_argument('--chunked', action='store_true', help='GET_DATA 02 01, else whole files')
+    parser.add_argument('--compress', action='store_true', help='[downlink] compress = 1')
+    parser.add_argument('--baud', type=int, default=115200, help='fast pace: wire time of replies, 0 = pty speed')
+    parser.add_argument('--polls', type=int, default=50, help='GET_STATE polls for the latency')
+    parser.add_argument('--missions', type=int, default=10, help='missions to send')
+    parser.add_argument('--mission', default='0f06', help='mission payload in hex, default an empty pipeline')
+    parser.add_argument('--seed', type=int, default=5, help='mission folders put in the outbox before boot')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch folder and obc.log')
+    args = parser.parse_args()
+
+    # seeded missions are numbered from SEED_FIRST, the OBC numbers the run's after them
+    SEED_FIRST = 100
+    runFirst = SEED_FIRST + args.seed
+    folder = tempfile.mkdtemp(prefix='teensy_emu_')
+    seeded = seedOutbox(folder, args.seed, SEED_FIRST)
+    master, slave = pty.openpty()
+    start = time.monotonic()
+    obc = startObc(folder, os.ttyname(slave), args.framing, args.compress)
+    teensy = TeensyEmulator(master, args.pace, args.framing, args.chunked, baud=args.baud)
+    try:
+        # boot: until GET_STATE is answered READY
+        saved, teensy.pace = teensy.pace, 'fast'
+        while not teensy.getState():
+            if obc.poll() is not None or time.monotonic() - start > 60:
+                raise RuntimeError(f'OBC did not come up, see {folder}/obc.log')
+        boot = time.monotonic() - start
+        teensy.pace = saved
+        teensy.latency.clear()
+
+        for _ in range(args.polls):
+            teensy.getState()
+
+        # the backlog left from earlier passes
+        drain = teensy.power()
+        drained = (teensy.files, teensy.fileBytes, teensy.wireBytes)
+
+        # one power cycle per mission as SAT0_Master runs it: rpi_mission()
+        # until ACKed, then check_rpi_status() each loop until the task is
+        # completed. Its output must be down by then, POWER_OFF comes next.
+        payload = bytes.fromhex(args.mission)
+        acked = late = 0
+        cycles = []
+        start = time.monotonic()
+        for _ in range(args.missions):
+            cycle = time.monotonic()
+            for _ in range(RPI_COMMAND_TRIES):
+                if teensy.mission(payload):
+                    break
+                time.sleep(LOOP_SECS[teensy.pace])
+            else:
+                continue
+            acked += 1
+            before = {m for m in teensy.missions if m >= runFirst}
+            teensy.power()
+            if not {m for m in teensy.missions if m >= runFirst} - before:
+                # completed before anything of the mission came down
+                late += 1
+            cycles.append(time.monotonic() - cycle)
+        missions = time.monotonic() - start
+    finally:
+        os.killpg(obc.pid, signal.SIGTERM)
+        obc.wait(10)
+        os.close(master)
+        os.close(slave)
+
+    names = {c.value: c.name for c in CmdTypes}
+    print(f'pace {args.pace}, framing {args.framing}, {"chunked" if args.chunked else "whole files"}, '
+          f'compress {args.compress}')
+    print(f'boot until READY:  {boot:.2f} secs')
+    print(f'{"command":>20} {"n":>5} {"mean ms":>9} {"p50 ms":>8} {"max ms":>8}')
+    for cmd, times in sorted(teensy.latency.items()):
+        print(f'{names.get(cmd, hex(cmd)):>20} {len(times):>5} {sum(times) / len(times) * 1000:>9.2f} '
+              f'{percentile(times, 0.5) * 1000:>8.2f} {max(times) * 1000:>8.2f}')
+    files, fileBytes, wireBytes = drained
+    print(f'outbox drain:      {drain:.2f} secs, {files} files ({seeded} seeded), '
+          f'{fileBytes} payload bytes in {wireBytes} wire bytes, '
+          f'{wireBytes / drain if drain else 0:.0f} wire B/s, '
+          f'{fileBytes / drain if drain else 0:.0f} payload B/s, oversize {teensy.oversize}')
+    print(f'missions:          {acked}/{args.missions} ACKed, {late} completed before their output came down, '
+          f'{missions:.2f} secs, {acked / missions * 3600 if missions else 0:.0f} cycles per hour'
+          + (f', cycle p50 {percentile(cycles, 0.5):.2f} secs' if cycles else ''))
+    print(f'undecodable:       {teensy.undecodable} compressed payloads the Teensy and ground cannot read')
+    left = sum(len(files) for _, _, files in os.walk(os.path.join(folder, 'outbox')))
+    print(f'left in outbox:    {left} files')
+    if args.keep:
+        print(f'scratch: {folder}')
+    else:
+        shutil.rmtree(folder)